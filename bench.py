@@ -0,0 +1,223 @@
+"""Benchmarks the whole server on the simulated light with local stand-ins for the DB, OWM, NOAA and Google APIs.
+
+Usage: python bench.py [--pollers N] [--duration S] [--output FILE]
+Prints one JSON document, so results can be diffed between commits before deploying to the Pis.
+"""
+import argparse
+import atexit
+import http.client
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import urllib.request
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import monotonic, perf_counter, process_time, sleep, time
+from urllib.parse import urlparse, parse_qs
+
+CPU_MODES = ['idle', 'auto', 'party', 'emergency', 'sos', 's_bahn', 'biergarten', 'racing', 'space', 'stau']
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# --- Upstream Stand-ins ---
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """Canned responses shaped like the real DB, OWM, NOAA and Google endpoints."""
+    def log_message(self, *args): pass
+
+    def do_GET(self):
+        path = urlparse(self.path)
+        if path.path.startswith('/db/plan/'):
+            now = datetime.now()
+            stops = ''.join(f'<s id="b{i}"><dp pt="{(now + timedelta(minutes=7 * i)).strftime("%y%m%d%H%M")}" ppth="Ottobrunn|Ostbahnhof|Pasing"/></s>' for i in range(1, 9))
+            self.reply(f'<timetable station="Ottobrunn">{stops}</timetable>', 'application/xml')
+        elif path.path.startswith('/db/'):
+            self.reply('<timetable station="Ottobrunn"/>', 'application/xml')
+        elif path.path == '/owm':
+            self.reply(json.dumps({'main': {'temp': 22.5}, 'weather': [{'main': 'Clear'}]}))
+        elif path.path == '/noaa':
+            self.reply(json.dumps([["time_tag", "Kp"], [datetime.now().isoformat(), "3.33"]]))
+        elif path.path == '/gmaps':
+            query = parse_qs(path.query)
+            columns = len(query['destinations'][0].split('|'))
+            element = {'status': 'OK', 'duration': {'value': 1200, 'text': '20 mins'}, 'duration_in_traffic': {'value': 1500, 'text': '25 mins'}}
+            self.reply(json.dumps({'status': 'OK', 'rows': [{'elements': [element] * columns} for _ in query['origins'][0].split('|')]}))
+        else:
+            self.send_response(404); self.end_headers()
+
+    def reply(self, body, content_type='application/json'):
+        body = body.encode('utf-8')
+        self.send_response(200); self.send_header('Content-type', content_type); self.send_header('Content-Length', str(len(body))); self.end_headers()
+        self.wfile.write(body)
+
+class ThreadingUpstream(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_upstream():
+    """Starts the stand-in APIs and points the server's environment at them. Must run before the server is imported.
+
+    The state file and departures cache go to a scratch directory, so canned plans never reach the real cache get_s5 reads.
+    """
+    scratch = tempfile.mkdtemp(prefix='traffic_light_bench_')
+    atexit.register(shutil.rmtree, scratch, True)
+    upstream = ThreadingUpstream(('127.0.0.1', 0), UpstreamHandler)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{upstream.server_port}"
+    os.environ.update({
+        'LIGHT_BACKEND': 'sim', 'HTTP_PORT': str(free_port()), 'IRACING_UDP_PORT': str(free_port(socket.SOCK_DGRAM)),
+        'DB_CLIENT_ID': 'bench', 'DB_CLIENT_SECRET': 'bench', 'OWM_API_KEY': 'bench', 'GOOGLE_MAPS_API_KEY': 'bench',
+        'STATE_FILE': os.path.join(scratch, 'state.json'), 'DEPARTURES_CACHE': os.path.join(scratch, 'departures.json'),
+        'DB_API_BASE': f"{base}/db", 'OWM_API_URL': f"{base}/owm", 'NOAA_KP_URL': f"{base}/noaa", 'GOOGLE_DISTANCE_MATRIX_URL': f"{base}/gmaps",
+    })
+
+# --- Harness ---
+class Bench:
+    def __init__(self, server):
+        self.server = server
+        self.backend = server.light_backend
+        self.base = f"http://127.0.0.1:{server.HTTP_PORT}"
+
+    def start(self):
+        threading.Thread(target=self.server.traffic_light_controller, daemon=True, name='controller').start()
+        self.server.start_monitors()
+        threading.Thread(target=self.server.iracing_udp_listener, daemon=True, name='udp').start()
+        threading.Thread(target=self.server.run_server, daemon=True, name='http').start()
+        deadline = monotonic() + 10
+        while monotonic() < deadline:
+            try:
+                self.get('/status'); return
+            except OSError:
+                sleep(0.05)
+        raise RuntimeError("server did not come up")
+
+    def get(self, path):
+        with urllib.request.urlopen(self.base + path, timeout=10) as response:
+            return response.read()
+
+    def set_mode(self, mode):
+        """Switches mode without tripping the toggle-to-idle behaviour of repeated clicks."""
+        if json.loads(self.get('/status'))['mode'] != mode:
+            self.get(f'/?action=set_mode&mode={mode}')
+        deadline = monotonic() + 2
+        while self.server.state.mode != mode and monotonic() < deadline: sleep(0.001)
+
+    def next_transition(self, after, timeout=2.0):
+        """Time of the first simulated light transition at or after `after`, or None on timeout."""
+        def find():
+            transitions = self.backend.transitions
+            if not transitions or transitions[-1][0] < after: return None
+            return next(t for t, _ in transitions if t >= after)
+        with self.backend.changed: # SimulatedBackend appends under this lock, so the deque is stable while we scan it.
+            self.backend.changed.wait_for(find, timeout)
+            return find()
+
+    def status_throughput(self, pollers, duration):
+        latencies, stop = [], monotonic() + duration
+        def poll():
+            local = []
+            connection = http.client.HTTPConnection('127.0.0.1', self.server.HTTP_PORT, timeout=10) # Keep-alive, like a browser.
+            while monotonic() < stop:
+                start = perf_counter()
+                connection.request('GET', '/status'); connection.getresponse().read()
+                local.append(perf_counter() - start)
+            connection.close()
+            latencies.extend(local)
+        threads = [threading.Thread(target=poll) for _ in range(pollers)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        latencies.sort()
+        return {'pollers': pollers, 'requests_per_s': len(latencies) / duration, 'p50_ms': percentile(latencies, 50) * 1000, 'p99_ms': percentile(latencies, 99) * 1000}
+
+    def command_latency(self, rounds=20):
+        """Time from sending ?action=set_mode until the light actually changes."""
+        self.set_mode('idle')
+        samples = []
+        for _ in range(rounds):
+            start = monotonic()
+            self.get('/?action=set_mode&mode=emergency') # Toggles between emergency (yellow) and idle (off).
+            transition = self.next_transition(start)
+            if transition is not None: samples.append(transition - start)
+            sleep(0.05)
+        return summarize(samples)
+
+    def udp_latency(self, rounds=50):
+        """Time from sending a telemetry packet in racing mode until the light shows its flag."""
+        self.set_mode('racing')
+        deadline = monotonic() + 6
+        live = self.server.programs['racing'].loop_index # The countdown is over once the program reaches its live step.
+        while self.server.state.race_step < live and monotonic() < deadline: sleep(0.01)
+        samples = []
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for i in range(rounds):
+                start = monotonic()
+                sock.sendto(self.server.encode_telemetry(i + 1, 'red' if i % 2 == 0 else 'green'), ('127.0.0.1', self.server.IRACING_UDP_PORT))
+                transition = self.next_transition(start)
+                if transition is not None: samples.append(transition - start)
+                sleep(0.01)
+        return summarize(samples)
+
+    def sos_timing(self):
+        """Deviation of the SOS step lengths from the built-in sos program over one full cycle."""
+        self.set_mode('idle')
+        durations = [row[2] for row in self.server.programs['sos'].timeline]
+        start = monotonic()
+        self.set_mode('sos')
+        sleep(sum(durations) + 0.5)
+        times = [t for t, _ in self.backend.transitions if t >= start]
+        errors = [abs((times[i + 1] - times[i]) - durations[i % len(durations)]) for i in range(min(len(times) - 1, len(durations)))]
+        return dict(summarize(errors), steps=len(errors))
+
+    def cpu_per_mode(self, window):
+        """Process CPU time as a share of wall time while each mode runs undisturbed."""
+        results = {}
+        for mode in CPU_MODES:
+            self.set_mode(mode)
+            sleep(0.5)
+            cpu, wall = process_time(), monotonic()
+            sleep(window)
+            results[mode] = round(100 * (process_time() - cpu) / (monotonic() - wall), 3)
+        return results
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] if ordered else None
+
+def summarize(samples):
+    ordered = sorted(samples)
+    to_ms = lambda value: None if value is None else value * 1000
+    return {'samples': len(ordered), 'p50_ms': to_ms(percentile(ordered, 50)), 'p99_ms': to_ms(percentile(ordered, 99)), 'max_ms': to_ms(ordered[-1] if ordered else None)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pollers', type=int, default=8, help="concurrent /status pollers")
+    parser.add_argument('--duration', type=float, default=5, help="seconds for the throughput run")
+    parser.add_argument('--cpu-window', type=float, default=3, help="seconds of CPU sampling per mode")
+    parser.add_argument('--output', help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    start_upstream()
+    import traffic_light_server as server
+    bench = Bench(server)
+    bench.start()
+    report = {
+        'timestamp': time(),
+        'python': sys.version.split()[0],
+        'status': bench.status_throughput(args.pollers, args.duration),
+        'set_mode_to_light': bench.command_latency(),
+        'udp_to_light': bench.udp_latency(),
+        'sos_timing_error': bench.sos_timing(),
+        'cpu_percent_per_mode': bench.cpu_per_mode(args.cpu_window),
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f: f.write(output + '\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Shared fetch engine: one scheduler, a small worker pool and pooled keep-alive HTTP sessions for all upstream sources."""
+import heapq
+import random
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, time
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import Counter, Histogram, FETCH_BUCKETS
+
+BACKOFF_BASE_S = 5
+MAX_CACHED_VALIDATORS = 64
+FETCH_DURATION = Histogram('traffic_light_fetch_duration_seconds', "Upstream fetch time per source, successful or not.", FETCH_BUCKETS, ('source',))
+FETCH_ERRORS = Counter('traffic_light_fetch_errors_total', "Failed upstream fetches per source.", ('source',))
+
+class Source:
+    """One upstream source: a fetch function, its refresh policy and the last good value it produced."""
+    def __init__(self, name, fetch, interval, on_update):
+        self.name, self.fetch, self.interval, self.on_update = name, fetch, interval, on_update
+        self.value = None
+        self.fetched_at = None
+        self.failures = 0
+        self.last_attempt = None
+        self.running = False
+        self.token = None # Sequence number of the one queue entry that is still valid for this source.
+
+    def next_interval(self):
+        """Seconds between fetches right now, or None while the source is suspended."""
+        return self.interval() if callable(self.interval) else self.interval
+
+    def age(self):
+        return None if self.fetched_at is None else time() - self.fetched_at
+
+class FetchEngine:
+    """Runs every registered source on a shared worker pool, with jittered backoff and conditional requests."""
+    def __init__(self, workers=3):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=workers)
+        self.session.mount('http://', adapter); self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fetch')
+        self.sources = {}
+        self.validators = {} # url -> last response carrying an ETag or Last-Modified header
+        self.validators_lock = threading.Lock()
+        self.schedule_lock = threading.Condition()
+        self.queue = []
+        self.sequence = 0
+
+    def get(self, url, headers=None, timeout=15):
+        """GET through the pooled session, revalidating with If-None-Match/If-Modified-Since when we can."""
+        headers = dict(headers or {})
+        with self.validators_lock: cached = self.validators.get(url)
+        if cached is not None:
+            if cached.headers.get('ETag'): headers['If-None-Match'] = cached.headers['ETag']
+            if cached.headers.get('Last-Modified'): headers['If-Modified-Since'] = cached.headers['Last-Modified']
+        response = self.session.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and cached is not None:
+            return cached
+        response.raise_for_status()
+        if response.headers.get('ETag') or response.headers.get('Last-Modified'):
+            response.content # Read the body now so the cached response no longer holds a pooled connection.
+            with self.validators_lock:
+                self.validators.pop(url, None); self.validators[url] = response
+                while len(self.validators) > MAX_CACHED_VALIDATORS: del self.validators[next(iter(self.validators))]
+        return response
+
+    def register(self, name, fetch, interval, on_update, value=None, fetched_at=None):
+        """Adds a source; fetch(engine) returns the new value and on_update(value, fetched_at) publishes it.
+
+        interval is a number of seconds or a function returning one, or None to suspend the source.
+        A value and epoch fetched_at restored from a snapshot count as its last fetch, so fresh data isn't fetched again.
+        """
+        source = self.sources[name] = Source(name, fetch, interval, on_update)
+        if fetched_at is not None:
+            source.value, source.fetched_at = value, fetched_at
+            source.last_attempt = monotonic() - max(0, time() - fetched_at)
+        self.reschedule(source)
+        return source
+
+    def schedule(self, source, delay):
+        """Queues the next fetch of a source, replacing any earlier plan for it; delay None suspends it."""
+        with self.schedule_lock:
+            if delay is None:
+                source.token = None; return
+            self.sequence += 1
+            source.token = self.sequence
+            heapq.heappush(self.queue, (monotonic() + delay, self.sequence, source.name))
+            self.schedule_lock.notify()
+
+    def reschedule(self, source):
+        """Plans a source's next fetch one interval after its last attempt, or at once if it never ran."""
+        interval = source.next_interval()
+        if interval is None or source.last_attempt is None: self.schedule(source, interval if interval is None else 0)
+        else: self.schedule(source, max(0, source.last_attempt + interval - monotonic()))
+
+    def replan(self):
+        """Re-applies every source's interval policy, e.g. after the light changed mode.
+
+        A source that is now wanted sooner is fetched at once if its data is older than its interval,
+        and one that nobody needs any more stops being fetched.
+        """
+        with self.schedule_lock:
+            for source in self.sources.values():
+                if source.running or (source.failures and source.token is not None): continue # Their completion or queued retry reschedules them.
+                self.reschedule(source)
+
+    def snapshot(self):
+        """Last good value and epoch fetch time of every source that has one."""
+        return {name: {'value': source.value, 'fetched_at': source.fetched_at} for name, source in list(self.sources.items()) if source.fetched_at is not None}
+
+    def ages(self):
+        """Seconds since each source's last good value, or None if it never produced one."""
+        return {name: None if source.age() is None else round(source.age()) for name, source in self.sources.items()}
+
+    def run(self):
+        """Scheduler loop: hands each due source to the worker pool. Runs in its own thread."""
+        with self.schedule_lock:
+            while True:
+                if not self.queue:
+                    self.schedule_lock.wait(); continue
+                due, sequence, name = self.queue[0]
+                source = self.sources[name]
+                if sequence != source.token:
+                    heapq.heappop(self.queue); continue # Superseded by a later schedule() or suspended.
+                if due > monotonic():
+                    self.schedule_lock.wait(due - monotonic()); continue
+                heapq.heappop(self.queue)
+                source.token, source.running = None, True
+                self.executor.submit(self.run_source, source)
+
+    def run_source(self, source):
+        start = source.last_attempt = monotonic()
+        try:
+            value = source.fetch(self)
+            fetched_at = time()
+            source.on_update(value, fetched_at)
+        except Exception as e:
+            FETCH_ERRORS.inc((source.name,))
+            # Keep the last good value; retry sooner than the full interval, with jitter so sources don't sync up.
+            source.failures += 1
+            interval = source.next_interval()
+            delay = None if interval is None else min(interval, BACKOFF_BASE_S * 2 ** (source.failures - 1)) * random.uniform(0.5, 1.5)
+            print(f"Error fetching {source.name} data (retry in {'-' if delay is None else f'{delay:.0f}'}s): {e}", file=sys.stderr)
+            if delay is None: self.suspend_failed(source)
+            self.finish(source, delay)
+            return
+        finally:
+            FETCH_DURATION.observe(monotonic() - start, (source.name,))
+        source.failures = 0
+        source.value, source.fetched_at = value, fetched_at
+        self.finish(source, source.next_interval())
+
+    def suspend_failed(self, source):
+        """Ends the backoff streak of a source that failed while suspended, so replan() handles it like any other;
+        its next plan then counts from the last good value, not from the failed attempt."""
+        source.failures = 0
+        source.last_attempt = None if source.fetched_at is None else monotonic() - max(0, time() - source.fetched_at)
+
+    def finish(self, source, delay):
+        with self.schedule_lock:
+            source.running = False
+            self.schedule(source, delay)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True, name='fetch-scheduler').start()
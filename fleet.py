@@ -0,0 +1,160 @@
+"""Fleet replication: one coordinator runs the monitors and programs, followers mirror its light over UDP multicast.
+
+Every frame carries the coordinator's monotonic send time and the time at which the light should change, a little in
+the future. Followers estimate the clock offset as the minimum (receive time - send time) over recent frames, which
+tracks the true offset plus the smallest network delay, and switch at apply_at + offset. The coordinator delays its
+own writes by the same lead, so the whole fleet switches together.
+"""
+import os
+import queue
+import select
+import socket
+import struct
+import sys
+import threading
+from collections import deque
+from time import monotonic, sleep
+
+# Frame: magic "TF", format version, sender epoch, uint32 sequence, sent_at, apply_at, color mask, mode name.
+FLEET_FRAME = struct.Struct('!2sBIIddB24s')
+FLEET_MAGIC, FLEET_VERSION = b'TF', 1
+FLEET_LEAD_S = 0.05 # Enough for a LAN hop plus scheduling jitter on a busy Pi.
+FLEET_HEARTBEAT_S = 0.5
+FLEET_TIMEOUT_S = 3 # Followers run on their own after this much silence.
+FLEET_OFFSET_WINDOW = 64
+FLEET_REORDER_WINDOW = 256
+
+def encode_frame(epoch, sequence, sent_at, apply_at, mask, mode):
+    return FLEET_FRAME.pack(FLEET_MAGIC, FLEET_VERSION, epoch, sequence & 0xFFFFFFFF, sent_at, apply_at, mask, mode.encode('utf-8')[:24])
+
+def decode_frame(data):
+    """Returns (epoch, sequence, sent_at, apply_at, mask, mode), or None if the datagram is not a fleet frame."""
+    if len(data) != FLEET_FRAME.size or data[:2] != FLEET_MAGIC: return None
+    _, version, epoch, sequence, sent_at, apply_at, mask, mode = FLEET_FRAME.unpack(data)
+    if version != FLEET_VERSION: return None
+    return epoch, sequence, sent_at, apply_at, mask, mode.rstrip(b'\0').decode('utf-8', 'replace')
+
+class FleetCoordinator:
+    """Broadcasts every light change with a short lead and applies it locally at the same moment."""
+    role = 'coordinator'
+
+    def __init__(self, group, port, write, lead=FLEET_LEAD_S):
+        self.address, self.write, self.lead = (group, port), write, lead
+        self.epoch = int.from_bytes(os.urandom(4), 'big')
+        self.sequence = 0
+        self.last = None # (apply_at, mask, mode) of the latest change, re-sent as the heartbeat.
+        self.send_lock = threading.Lock() # Changes and heartbeats come from different threads.
+        self.pending = queue.Queue()
+        self.stats = {'sent': 0, 'send_errors': 0}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+
+    def publish(self, mask, mode):
+        """Called by the controller instead of writing the light; cheap and never blocks."""
+        with self.send_lock:
+            if self.last is not None and self.last[1:] == (mask, mode): return
+            self.last = change = (monotonic() + self.lead, mask, mode)
+            self.send(*change)
+        self.pending.put(change[:2])
+
+    def heartbeat(self):
+        with self.send_lock:
+            if self.last is not None: self.send(*self.last)
+
+    def send(self, apply_at, mask, mode):
+        """Caller holds send_lock, so sequence numbers are unique and frames leave in sequence order, and a heartbeat
+        never repeats an older state after a newer one."""
+        self.sequence += 1
+        try:
+            self.sock.sendto(encode_frame(self.epoch, self.sequence, monotonic(), apply_at, mask, mode), self.address)
+            self.stats['sent'] += 1
+        except OSError as e:
+            self.stats['send_errors'] += 1
+            print(f"Fleet: could not send frame: {e}", file=sys.stderr)
+
+    def run(self):
+        """Applies queued changes at their apply time, and sends heartbeats while the light is steady."""
+        while True:
+            try:
+                apply_at, mask = self.pending.get(timeout=FLEET_HEARTBEAT_S)
+            except queue.Empty:
+                self.heartbeat()
+                continue
+            delay = apply_at - monotonic()
+            if delay > 0: sleep(delay)
+            self.write(mask)
+
+    def status(self):
+        return {'role': self.role, 'stats': dict(self.stats)}
+
+class FleetFollower:
+    """Mirrors the coordinator's frames. Calls on_follow(following) when the coordinator appears or goes silent."""
+    role = 'follower'
+
+    def __init__(self, group, port, apply, on_follow, timeout=FLEET_TIMEOUT_S):
+        self.group, self.port, self.apply, self.on_follow, self.timeout = group, port, apply, on_follow, timeout
+        self.following = True # Assume the coordinator is up, so a restarting fleet doesn't hit the upstream APIs at once.
+        self.epoch = self.last_sequence = self.queued = None
+        self.samples = deque(maxlen=FLEET_OFFSET_WINDOW)
+        self.offset = None
+        self.stats = {'received': 0, 'dropped': 0, 'applied': 0}
+
+    def open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', self.port))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton('0.0.0.0')))
+        sock.setblocking(False)
+        return sock
+
+    def accept(self, frame, received_at):
+        """Tracks the sender and clock offset; returns the local apply time, or None for a stale frame."""
+        epoch, sequence, sent_at, apply_at, mask, mode = frame
+        if epoch != self.epoch: # The coordinator restarted: its clock and sequence numbers start over.
+            self.epoch, self.last_sequence, self.queued = epoch, None, None
+            self.samples.clear()
+        elif self.last_sequence is not None and (self.last_sequence - sequence) % 2**32 <= FLEET_REORDER_WINDOW:
+            return None
+        self.last_sequence = sequence
+        self.samples.append(received_at - sent_at)
+        self.offset = min(self.samples)
+        return apply_at + self.offset
+
+    def run(self):
+        sock = self.open_socket()
+        pending = deque() # (local apply time, mask, mode), in order.
+        last_frame = monotonic()
+        while True:
+            now = monotonic()
+            while pending and pending[0][0] <= now:
+                _, mask, mode = pending.popleft()
+                self.apply(mode, mask); self.stats['applied'] += 1
+            if pending: timeout = pending[0][0] - now
+            elif self.following: timeout = last_frame + self.timeout - now
+            else: timeout = None
+            if timeout is not None and timeout <= 0:
+                self.following, self.queued = False, None
+                self.on_follow(False)
+                continue
+            if not select.select([sock], [], [], timeout)[0]: continue
+            while True:
+                try:
+                    data = sock.recv(256)
+                except BlockingIOError:
+                    break
+                received_at = monotonic()
+                self.stats['received'] += 1
+                frame = decode_frame(data)
+                local_time = None if frame is None else self.accept(frame, received_at)
+                if local_time is None:
+                    self.stats['dropped'] += 1; continue
+                last_frame = received_at
+                if not self.following:
+                    self.following = True
+                    self.on_follow(True)
+                if frame[4:] != self.queued: # Heartbeats repeat the current state; only changes are scheduled.
+                    self.queued = frame[4:]
+                    pending.append((local_time, *self.queued))
+
+    def status(self):
+        return {'role': self.role, 'following': self.following, 'clock_offset_s': self.offset, 'stats': dict(self.stats)}
@@ -0,0 +1,98 @@
+"""Fixed-memory history of monitored signals: typed-array rings with coarser tiers for older data."""
+import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+HISTORY_RAW_POINTS = int(os.getenv("HISTORY_RAW_POINTS", 4096))
+HISTORY_WINDOW_S = int(os.getenv("HISTORY_WINDOW_S", 7 * 86400))
+# (resolution, span) of each downsampled tier; the last one covers the configured window.
+HISTORY_TIERS = ((60, 86400), (900, HISTORY_WINDOW_S))
+
+class Ring:
+    """Fixed-capacity ring of (time, value) samples kept in two preallocated arrays of doubles."""
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self.times = array('d', bytes(8 * self.capacity))
+        self.values = array('d', bytes(8 * self.capacity))
+        self.start = 0
+        self.count = 0
+
+    def append(self, t, value):
+        i = (self.start + self.count) % self.capacity
+        if self.count == self.capacity: self.start = (self.start + 1) % self.capacity
+        else: self.count += 1
+        self.times[i], self.values[i] = t, value
+
+    def oldest(self):
+        return self.times[self.start] if self.count else None
+
+    def ordered(self):
+        """Copies of the times and values in insertion order."""
+        end = self.start + self.count
+        if end <= self.capacity: return self.times[self.start:end], self.values[self.start:end]
+        end -= self.capacity
+        return self.times[self.start:] + self.times[:end], self.values[self.start:] + self.values[:end]
+
+AGGREGATES = {
+    'mean': lambda total, count, last: total / count,
+    'sum': lambda total, count, last: total,
+    'last': lambda total, count, last: last,
+}
+
+class Series:
+    """One signal: raw samples plus one ring per tier, each filled with per-bucket aggregates as buckets close."""
+    def __init__(self, name, aggregate='mean', raw_points=HISTORY_RAW_POINTS, tiers=HISTORY_TIERS):
+        self.name, self.aggregate = name, AGGREGATES[aggregate]
+        self.resolutions = (0,) + tuple(resolution for resolution, _ in tiers)
+        self.rings = [Ring(raw_points)] + [Ring(span // resolution) for resolution, span in tiers]
+        self.buckets = [[None, 0.0, 0, 0.0] for _ in tiers] # Open bucket per tier: start, total, count, last value.
+
+    def record(self, t, value):
+        self.rings[0].append(t, value)
+        for resolution, ring, bucket in zip(self.resolutions[1:], self.rings[1:], self.buckets):
+            start = t - t % resolution
+            if bucket[0] != start:
+                if bucket[2]: ring.append(bucket[0], self.aggregate(bucket[1], bucket[2], bucket[3]))
+                bucket[:] = [start, 0.0, 0, 0.0]
+            bucket[1] += value; bucket[2] += 1; bucket[3] = value
+
+    def query(self, since, until, step=None):
+        """Returns (resolution, times, values) from the finest tier still reaching back to `since`, rebucketed to `step`."""
+        tier = len(self.rings) - 1
+        for i, ring in enumerate(self.rings):
+            if ring.count < ring.capacity or ring.oldest() <= since: tier = i; break # A ring that never wrapped holds everything.
+        times, values = self.rings[tier].ordered()
+        bucket = self.buckets[tier - 1] if tier else None
+        if bucket is not None and bucket[2]: # Include the bucket that is still filling.
+            times.append(bucket[0]); values.append(self.aggregate(bucket[1], bucket[2], bucket[3]))
+        lo, hi = bisect_left(times, since), bisect_right(times, until)
+        times, values = times[lo:hi], values[lo:hi]
+        resolution = self.resolutions[tier]
+        if step is None or step <= resolution: return resolution, times, values
+        return step, *self.rebucket(times, values, step)
+
+    def rebucket(self, times, values, step):
+        out_times, out_values = array('d'), array('d')
+        start, total, count, last = None, 0.0, 0, 0.0
+        for t, value in zip(times, values):
+            bucket = t - t % step
+            if bucket != start:
+                if count: out_times.append(start); out_values.append(self.aggregate(total, count, last))
+                start, total, count = bucket, 0.0, 0
+            total += value; count += 1; last = value
+        if count: out_times.append(start); out_values.append(self.aggregate(total, count, last))
+        return out_times, out_values
+
+class History:
+    """The set of recorded signals. Writers and readers share one small lock; queries copy out and format unlocked."""
+    def __init__(self, signals):
+        self.series = {name: Series(name, aggregate) for name, aggregate in signals.items()}
+        self.lock = threading.Lock()
+
+    def record(self, name, t, value):
+        if value is None: return
+        with self.lock: self.series[name].record(t, float(value))
+
+    def query(self, name, since, until, step=None):
+        with self.lock: return self.series[name].query(since, until, step)
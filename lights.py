@@ -0,0 +1,83 @@
+"""Light backends: the traffic light as a 3-bit mask, written either to the GPIO pins or to an in-memory simulator."""
+import os
+import sys
+import threading
+from collections import deque
+from time import monotonic
+
+RED, YELLOW, GREEN = 0b100, 0b010, 0b001
+COLOR_MASKS = {'off': 0, 'red': RED, 'yellow': YELLOW, 'green': GREEN, 'red_and_yellow': RED | YELLOW, 'green-yellow': GREEN | YELLOW, 'all_on': RED | YELLOW | GREEN}
+PINS = {RED: 22, YELLOW: 27, GREEN: 17}
+
+class LightBackend:
+    """Tracks the current mask so that subclasses only ever see the bits that change."""
+    def __init__(self):
+        self.mask = 0
+
+    def write(self, mask):
+        changed = self.mask ^ mask
+        if changed:
+            self.apply(mask, changed)
+            self.mask = mask
+
+    def apply(self, mask, changed):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class GpiozeroBackend(LightBackend):
+    """The real light: active-low LEDs on the BCM pins in PINS."""
+    def __init__(self, pins=PINS):
+        super().__init__()
+        from gpiozero import LED
+        self.pins = pins
+        self.leds = {bit: LED(pin, active_high=False) for bit, pin in pins.items()}
+        self.bank = self.pigpio_bank()
+
+    def pigpio_bank(self):
+        """The pigpio connection when gpiozero runs on the pigpio pin factory, which can switch several pins per call."""
+        try:
+            from gpiozero.pins.pigpio import PiGPIOFactory
+        except ImportError:
+            return None
+        factory = next(iter(self.leds.values())).pin_factory
+        return factory.connection if isinstance(factory, PiGPIOFactory) else None
+
+    def apply(self, mask, changed):
+        if self.bank is not None:
+            # Active-low wiring: clearing a pin lights its lamp. Each bank call is a single register write.
+            lit = sum(1 << self.pins[bit] for bit in self.pins if changed & mask & bit)
+            dark = sum(1 << self.pins[bit] for bit in self.pins if changed & ~mask & bit)
+            if dark: self.bank.set_bank_1(dark)
+            if lit: self.bank.clear_bank_1(lit)
+            return
+        for bit, led in self.leds.items():
+            if changed & bit:
+                if mask & bit: led.on()
+                else: led.off()
+
+    def close(self):
+        for led in self.leds.values(): led.close()
+
+class SimulatedBackend(LightBackend):
+    """In-memory light that records timestamped transitions, for running and timing the server off the Pi."""
+    def __init__(self, history=10000):
+        super().__init__()
+        self.transitions = deque(maxlen=history)
+        self.changed = threading.Condition()
+
+    def apply(self, mask, changed):
+        with self.changed:
+            self.transitions.append((monotonic(), mask))
+            self.changed.notify_all()
+
+def create_light_backend():
+    """Backend selected by LIGHT_BACKEND ('gpio' or 'sim'); falls back to the simulator when gpiozero is missing."""
+    if os.getenv("LIGHT_BACKEND", "gpio") == "sim":
+        return SimulatedBackend()
+    try:
+        return GpiozeroBackend()
+    except ImportError as e:
+        print(f"GPIO unavailable ({e}); using the simulated light.", file=sys.stderr)
+        return SimulatedBackend()
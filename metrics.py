@@ -0,0 +1,106 @@
+"""Cheap in-process instrumentation: counters, fixed-bucket histograms and a timed lock, rendered as Prometheus text.
+
+Updates are plain integer and float operations without locks of their own; under the GIL a rare lost increment is
+an acceptable price for never making the controller wait on instrumentation.
+"""
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+FETCH_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15)
+REGISTRY = []
+
+def format_labels(names, values):
+    if not names: return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} counter"
+        for labels, value in list(self.values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name, self.help, self.buckets, self.labelnames = name, help, tuple(buckets), labelnames
+        self.series = {} # labels -> [per-bucket counts (last one is +Inf), sum]
+        REGISTRY.append(self)
+
+    def observe(self, value, labels=()):
+        series = self.series.get(labels)
+        if series is None: series = self.series.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} histogram"
+        for labels, (counts, total) in list(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{format_labels(self.labelnames + ('le',), labels + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}"
+
+class Callback:
+    """A series whose samples are read from a function at scrape time, for values the code already tracks."""
+    def __init__(self, name, help, kind, labelnames, read):
+        self.name, self.help, self.kind, self.labelnames, self.read = name, help, kind, labelnames, read
+        REGISTRY.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}"
+        for labels, value in self.read().items():
+            if value is not None: yield f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+
+def render_metrics():
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+_roles = threading.local()
+
+def thread_role():
+    """Short, low-cardinality name of the calling thread, e.g. 'controller', 'http' or 'fetch'.
+
+    Every thread is named where it is started; pool workers such as 'fetch_0' count under their prefix.
+    """
+    role = getattr(_roles, 'name', None)
+    if role is None:
+        role = _roles.name = threading.current_thread().name.split('_')[0]
+    return role
+
+class TimedLock:
+    """A threading.Lock that records how long each thread role waits for it and holds it."""
+    def __init__(self, wait_histogram, hold_histogram):
+        self.lock = threading.Lock()
+        self.wait_histogram, self.hold_histogram = wait_histogram, hold_histogram
+        self.acquired_at = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            self.acquired_at = perf_counter()
+            if blocking: self.wait_histogram.observe(self.acquired_at - start, (thread_role(),))
+        return acquired
+
+    def release(self):
+        self.hold_histogram.observe(perf_counter() - self.acquired_at, (thread_role(),))
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,247 @@
+"""Declarative light programs, compiled once into a flat timeline table that the controller steps through by deadline.
+
+A program is JSON: {"name": ..., "steps": [...], "loop_to": <label>}. Steps are
+  {"color": "red", "duration": 20}                  show a color for a fixed time
+  {"color": "red", "hold": true}                    show it until new data arrives (optional "duration" re-checks periodically)
+  {"color": {"signal": "iracing_flag"}, ...}        show whatever color a signal currently names (COLOR_SIGNALS only)
+  {"random": ["red", "off"], "duration": 0.08}      show a random one of the colors
+  {"repeat": 3, "steps": [...]}                     repeat a block (unrolled at compile time)
+  {"if": <condition>, "then": [...], "else": [...]} branch on live data
+  {"switch": [{"when": <condition>, "steps": [...]}, ..., {"steps": [...]}]}  first matching case wins
+Any step may carry a "label". After its last step, and whenever a held step is woken, a program continues at
+"loop_to" (default: the start), so data-driven programs re-evaluate their branches.
+Conditions: {"signal": name, "<op>": value, ...} with ops lt, le, gt, ge, eq, ne, in, contains, missing;
+combine them with {"any": [...]}, {"all": [...]} and {"not": ...}.
+"""
+import math
+import operator
+import random
+from lights import COLOR_MASKS
+
+SHOW, SIGNAL, RANDOM, BRANCH, JUMP = range(5)
+MAX_TIMELINE_STEPS = 4096
+MIN_STEP_DURATION_S = 0.02
+COLOR_SIGNALS = frozenset(['iracing_flag', 'manual_color', 'color']) # Signals whose values are color names.
+MAX_PROGRAM_NAME_BYTES = 24 # The mode field of a fleet frame; a longer name would reach followers cut short.
+MAX_STEP_DURATION_S = 86400 # Longer waits overflow the platform's timeouts; hold the step instead.
+OPERATORS = {
+    'lt': operator.lt, 'le': operator.le, 'gt': operator.gt, 'ge': operator.ge, 'eq': operator.eq, 'ne': operator.ne,
+    'in': lambda value, options: value in options, 'contains': lambda value, part: part in value,
+}
+
+class ProgramError(ValueError):
+    pass
+
+class Program:
+    """A compiled program. Each timeline row is (kind, arg, duration, hold, next_index, else_index)."""
+    def __init__(self, name, timeline, labels, loop_index, source, builtin):
+        self.name, self.timeline, self.labels, self.loop_index, self.source, self.builtin = name, timeline, labels, loop_index, source, builtin
+
+def safely(test, value, operand):
+    """Applies a comparison, treating mismatched types (a number against a string) as false rather than crashing the controller."""
+    try:
+        return test(value, operand)
+    except TypeError:
+        return False
+
+def compile_condition(condition, signals):
+    if not isinstance(condition, dict): raise ProgramError(f"condition must be an object: {condition!r}")
+    if 'any' in condition:
+        parts = [compile_condition(part, signals) for part in condition['any']]
+        return lambda: any(part() for part in parts)
+    if 'all' in condition:
+        parts = [compile_condition(part, signals) for part in condition['all']]
+        return lambda: all(part() for part in parts)
+    if 'not' in condition:
+        part = compile_condition(condition['not'], signals)
+        return lambda: not part()
+    read = signals.get(condition.get('signal'))
+    if read is None: raise ProgramError(f"unknown signal: {condition.get('signal')!r}")
+    tests = []
+    for op, operand in condition.items():
+        if op == 'signal': continue
+        if op == 'missing': tests.append(lambda value, expected=bool(operand): (value is None) == expected); continue
+        if op not in OPERATORS: raise ProgramError(f"unknown operator: {op!r}")
+        tests.append(lambda value, test=OPERATORS[op], operand=operand: value is not None and safely(test, value, operand))
+    if not tests: raise ProgramError(f"condition on {condition['signal']!r} has no test")
+    if len(tests) == 1:
+        test = tests[0]
+        return lambda: test(read())
+    return lambda: all(test(value) for value in (read(),) for test in tests)
+
+def check_color(color):
+    if color not in COLOR_MASKS: raise ProgramError(f"unknown color: {color!r}")
+    return color
+
+def repeat_count(value):
+    try:
+        count = int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ProgramError(f"repeat count must be an integer: {value!r}") from None
+    if not 0 <= count <= MAX_TIMELINE_STEPS: raise ProgramError(f"repeat count out of range: {value!r}")
+    return count
+
+def count_expansion(timeline, expanded):
+    expanded[0] += 1
+    if len(timeline) > MAX_TIMELINE_STEPS or expanded[0] > MAX_TIMELINE_STEPS:
+        raise ProgramError(f"program compiles to more than {MAX_TIMELINE_STEPS} steps")
+
+def compile_steps(steps, timeline, labels, signals, expanded):
+    """Appends the rows for `steps`. `expanded` is a one-item list counting every step compiled, unrolled copies
+    included, so nested or empty repeats cannot make compiling itself unbounded."""
+    if not isinstance(steps, list): raise ProgramError("steps must be a list")
+    for step in steps:
+        if not isinstance(step, dict): raise ProgramError(f"step must be an object: {step!r}")
+        count_expansion(timeline, expanded)
+        if 'label' in step: labels[step['label']] = len(timeline)
+        if 'repeat' in step:
+            count = repeat_count(step['repeat'])
+            if not step.get('steps'): raise ProgramError("repeat needs a non-empty steps list")
+            for _ in range(count): compile_steps(step['steps'], timeline, labels, signals, expanded)
+        elif 'if' in step:
+            compile_branches([{'when': step['if'], 'steps': step.get('then', [])}, {'steps': step.get('else', [])}], timeline, labels, signals, expanded)
+        elif 'switch' in step:
+            compile_branches(step['switch'], timeline, labels, signals, expanded)
+        elif 'color' in step or 'random' in step:
+            duration, hold = step.get('duration'), bool(step.get('hold')) or step.get('duration') is None
+            if duration is not None and (isinstance(duration, bool) or not isinstance(duration, (int, float))
+                                         or not math.isfinite(duration) or not MIN_STEP_DURATION_S <= duration <= MAX_STEP_DURATION_S):
+                raise ProgramError(f"duration must be between {MIN_STEP_DURATION_S}s and {MAX_STEP_DURATION_S}s: {duration!r}")
+            if 'random' in step:
+                if not isinstance(step['random'], list) or not step['random']: raise ProgramError("random needs a non-empty list of colors")
+                row = (RANDOM, tuple(check_color(color) for color in step['random']), duration, hold)
+            elif isinstance(step['color'], dict):
+                read = signals.get(step['color'].get('signal'))
+                if read is None: raise ProgramError(f"unknown signal: {step['color'].get('signal')!r}")
+                if step['color']['signal'] not in COLOR_SIGNALS: raise ProgramError(f"signal {step['color']['signal']!r} does not name a color")
+                row = (SIGNAL, read, duration, hold)
+            else:
+                row = (SHOW, check_color(step['color']), duration, hold)
+            timeline.append(row + (len(timeline) + 1, None))
+        elif 'label' not in step:
+            raise ProgramError(f"unknown step: {step!r}")
+
+def compile_branches(cases, timeline, labels, signals, expanded):
+    """Compiles switch cases into a chain of BRANCH rows, with a JUMP past the remaining cases after each body."""
+    jumps = []
+    for case in cases:
+        count_expansion(timeline, expanded)
+        if 'when' in case:
+            branch = len(timeline); timeline.append(None)
+            compile_steps(case.get('steps', []), timeline, labels, signals, expanded)
+            jumps.append(len(timeline)); timeline.append(None)
+            timeline[branch] = (BRANCH, compile_condition(case['when'], signals), None, False, branch + 1, len(timeline))
+        else:
+            compile_steps(case.get('steps', []), timeline, labels, signals, expanded)
+            break
+    for jump in jumps: timeline[jump] = (JUMP, None, None, False, len(timeline), None)
+
+def compile_program(source, signals, builtin=False):
+    """Validates a program definition and compiles it against the available signal readers."""
+    if not isinstance(source, dict) or not isinstance(source.get('name'), str) or not source['name']:
+        raise ProgramError("program needs a non-empty string name")
+    if len(source['name'].encode('utf-8')) > MAX_PROGRAM_NAME_BYTES:
+        raise ProgramError(f"program name is longer than {MAX_PROGRAM_NAME_BYTES} UTF-8 bytes")
+    timeline, labels = [], {}
+    try:
+        compile_steps(source.get('steps'), timeline, labels, signals, [0])
+    except (TypeError, ValueError) as e: # Malformed values, like a non-numeric repeat count or a list as a label.
+        raise ProgramError(str(e)) from e
+    if not any(row[0] in (SHOW, SIGNAL, RANDOM) for row in timeline): raise ProgramError("program never shows a light")
+    loop_to = source.get('loop_to')
+    if loop_to is not None and loop_to not in labels: raise ProgramError(f"unknown loop_to label: {loop_to!r}")
+    loop_index = labels.get(loop_to, 0) if loop_to is not None else 0
+    if loop_index >= len(timeline): raise ProgramError("loop_to label points past the last step")
+    end = len(timeline)
+    timeline = [row[:4] + (loop_index if row[4] == end else row[4], loop_index if row[5] == end else row[5]) for row in timeline]
+    return Program(source['name'], tuple(timeline), labels, loop_index, source, builtin)
+
+class ProgramRunner:
+    """Steps through a compiled timeline. Step ends follow the previous deadline exactly, so patterns never drift."""
+    def __init__(self, show):
+        self.show = show
+        self.program = None
+        self.index = 0
+        self.anchor = 0.0
+        self.duration = None
+        self.hold = True
+
+    def start(self, program, now):
+        self.program, self.anchor = program, now
+        return self.enter(0)
+
+    def enter(self, index):
+        """Follows branches and jumps from `index` to the next displayable step, shows it and returns its deadline."""
+        timeline = self.program.timeline
+        for _ in range(len(timeline) + 1):
+            kind, arg, duration, hold, next_index, else_index = timeline[index]
+            if kind == BRANCH: index = next_index if arg() else else_index
+            elif kind == JUMP: index = next_index
+            else: break
+        else:
+            self.index, self.duration, self.hold = index, None, True # Branches loop without showing anything; wait for data.
+            return None
+        self.index, self.duration, self.hold = index, duration, hold
+        color = arg() if kind == SIGNAL else random.choice(arg) if kind == RANDOM else arg
+        self.show(color if color in COLOR_MASKS else 'off') # e.g. 'unknown' before the first light change.
+        return self.deadline()
+
+    def deadline(self):
+        return None if self.duration is None else self.anchor + self.duration
+
+    def advance(self, now, woken):
+        """Moves on if the current step is over, or re-evaluates a held step that new data woke; returns the next deadline."""
+        if self.program is None: return None
+        if self.duration is not None and now >= self.anchor + self.duration:
+            self.anchor += self.duration
+            if now - self.anchor > self.duration: self.anchor = now # Resync after a stall instead of replaying missed steps.
+            return self.enter(self.program.timeline[self.index][4])
+        if woken and self.hold:
+            self.anchor = now
+            return self.enter(self.program.loop_index)
+        return self.deadline()
+
+BLINK_RED = [{'color': 'red', 'duration': 0.5}, {'color': 'off', 'duration': 0.5}]
+BLINK_YELLOW = [{'color': 'yellow', 'duration': 0.5}, {'color': 'off', 'duration': 0.5}]
+SOS_PATTERN = [(0.2, 0.2), (0.2, 0.2), (0.2, 0.4), (0.6, 0.2), (0.6, 0.2), (0.6, 0.4), (0.2, 0.2), (0.2, 0.2), (0.2, 1.5)] # (on, off) seconds
+
+BUILTIN_PROGRAMS = [
+    {'name': 'idle', 'steps': [{'color': 'off', 'hold': True}]},
+    {'name': 'manual', 'steps': [{'color': {'signal': 'manual_color'}, 'hold': True}]},
+    {'name': 'auto', 'steps': [{'color': 'red', 'duration': 20}, {'color': 'red_and_yellow', 'duration': 2}, {'color': 'green', 'duration': 20}, {'color': 'yellow', 'duration': 3}]},
+    {'name': 'party', 'steps': [{'random': ['red', 'yellow', 'green', 'off'], 'duration': 0.08}]},
+    {'name': 'emergency', 'steps': BLINK_YELLOW},
+    {'name': 'sos', 'steps': [step for on, off in SOS_PATTERN for step in ({'color': 'all_on', 'duration': on}, {'color': 'off', 'duration': off})]},
+    {'name': 's_bahn', 'steps': [{'switch': [
+        {'when': {'signal': 's_bahn_minutes', 'missing': True}, 'steps': BLINK_RED},
+        {'when': {'signal': 's_bahn_minutes', 'lt': 9}, 'steps': [{'color': 'red', 'hold': True}]},
+        {'when': {'signal': 's_bahn_minutes', 'eq': 9}, 'steps': BLINK_YELLOW},
+        {'when': {'signal': 's_bahn_minutes', 'le': 12}, 'steps': [{'color': 'yellow', 'hold': True}]},
+        {'steps': [{'color': 'green', 'hold': True}]},
+    ]}]},
+    {'name': 'biergarten', 'steps': [{'switch': [
+        {'when': {'any': [{'signal': 'temperature', 'missing': True}, {'signal': 'weather_condition', 'missing': True}]}, 'steps': BLINK_RED},
+        {'when': {'any': [{'signal': 'hour', 'lt': 16}, {'signal': 'temperature', 'lt': 15}, {'signal': 'weather_condition', 'contains': 'Rain'}, {'signal': 'weather_condition', 'contains': 'Snow'}]},
+         'steps': [{'color': 'red', 'hold': True, 'duration': 300}]}, # Re-checked every few minutes for the 16:00 rule.
+        {'when': {'any': [{'signal': 'temperature', 'lt': 18}, {'signal': 'weather_condition', 'contains': 'Clouds'}]}, 'steps': [{'color': 'yellow', 'hold': True, 'duration': 300}]},
+        {'steps': [{'color': 'green', 'hold': True, 'duration': 300}]},
+    ]}]},
+    {'name': 'racing', 'loop_to': 'live', 'steps': [
+        {'color': 'red', 'duration': 1}, {'color': 'red_and_yellow', 'duration': 1}, {'color': 'all_on', 'duration': 1}, {'color': 'off', 'duration': 1},
+        {'label': 'live', 'color': {'signal': 'iracing_flag'}, 'hold': True},
+    ]},
+    {'name': 'space', 'steps': [{'switch': [
+        {'when': {'any': [{'signal': 'kp_index', 'missing': True}, {'signal': 'kp_index', 'ge': 5}]}, 'steps': BLINK_RED},
+        {'when': {'signal': 'kp_index', 'eq': 4}, 'steps': [{'color': 'yellow', 'hold': True}]},
+        {'steps': [{'color': 'green', 'hold': True}]},
+    ]}]},
+    # Thresholds drop by 5 points while the light already shows the higher level, so noisy readings don't flap.
+    {'name': 'stau', 'steps': [{'switch': [
+        {'when': {'signal': 'traffic_delay', 'missing': True}, 'steps': BLINK_RED},
+        {'when': {'any': [{'signal': 'traffic_delay', 'gt': 45}, {'all': [{'signal': 'color', 'eq': 'red'}, {'signal': 'traffic_delay', 'gt': 40}]}]},
+         'steps': [{'color': 'red', 'hold': True}]},
+        {'when': {'any': [{'signal': 'traffic_delay', 'gt': 20}, {'all': [{'signal': 'color', 'in': ['red', 'yellow']}, {'signal': 'traffic_delay', 'gt': 15}]}]},
+         'steps': [{'color': 'yellow', 'hold': True}]},
+        {'steps': [{'color': 'green', 'hold': True}]},
+    ]}]},
+]
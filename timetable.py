@@ -0,0 +1,248 @@
+"""Cached Deutsche Bahn timetable engine: parses each hourly plan once and merges real-time changes."""
+import contextlib
+import fcntl
+import json
+import math
+import os
+import sys
+import tempfile
+import requests
+import xml.etree.ElementTree as ET
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from time import time
+
+API_BASE = os.getenv("DB_API_BASE", "https://apis.deutschebahn.com/db-api-marketplace/apis/timetables/v1")
+
+# Destinations that are NOT towards the city center from Ottobrunn.
+# Trains going to these destinations count as direction 'out', all others as 'city'.
+OUTBOUND_DESTINATIONS = frozenset(["Kreuzstraße", "Aying", "Höhenkirchen-Siegertsbrunn", "Dürrnhaar", "Hohenbrunn", "Wächterhof"])
+
+FULL_CHANGES_INTERVAL_S = 600 # rchg only covers the last two minutes, so resync with fchg now and then.
+RECENT_CHANGES_WINDOW_S = 120 # After a longer gap since the last refresh, rchg would miss changes.
+MAX_DELAY_LOOKBACK_S = 1800 # A train planned this long ago may still be waiting on the platform.
+DIRECTIONS = ('city', 'out', 'all')
+# Next to the code and its state file rather than in the shared temp directory, where other users could plant it.
+DEPARTURES_CACHE = os.getenv("DEPARTURES_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "traffic_light_departures.json"))
+CHANGES_MAX_AGE_S = 60 # Cached delays older than this are refreshed before they are trusted.
+
+def parse_db_time(raw):
+    """Parses the API's yymmddHHMM timestamps into epoch seconds without strptime."""
+    return datetime(2000 + int(raw[0:2]), int(raw[2:4]), int(raw[4:6]), int(raw[6:8]), int(raw[8:10])).timestamp()
+
+def parse_plan(root):
+    """Turns a /plan document into sorted (departure times, stop ids, destinations) of every departing train."""
+    departures = []
+    for stop in root.findall('s'):
+        try:
+            dp = stop.find('dp')
+            departures.append((parse_db_time(dp.get('pt')), stop.get('id'), dp.get('ppth').split('|')[-1]))
+        except (AttributeError, TypeError, ValueError): continue
+    departures.sort()
+    return array('d', (t for t, _, _ in departures)), tuple(stop_id for _, stop_id, _ in departures), tuple(destination for _, _, destination in departures)
+
+def in_direction(destination, direction):
+    return direction == 'all' or (destination in OUTBOUND_DESTINATIONS) == (direction == 'out')
+
+def parse_changes(root):
+    """Maps stop id to the changed departure time, or None for cancellations, from a fchg/rchg document."""
+    changes = {}
+    for stop in root.findall('s'):
+        dp = stop.find('dp')
+        if dp is None: continue
+        try:
+            if dp.get('cs') == 'c': changes[stop.get('id')] = None
+            elif dp.get('ct'): changes[stop.get('id')] = parse_db_time(dp.get('ct'))
+        except ValueError: continue
+    return changes
+
+def is_time(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def cached_plan(entry):
+    """((date, hour), plan) from one exported plan entry, or None if it does not have the shape export() writes."""
+    if not isinstance(entry, list) or len(entry) != 5: return None
+    date, hour, times, ids, destinations = entry
+    if not (isinstance(date, str) and isinstance(hour, str) and all(isinstance(part, list) for part in (times, ids, destinations))): return None
+    if not len(times) == len(ids) == len(destinations) or not all(map(is_time, times)): return None
+    if not all(isinstance(text, str) for text in ids + destinations): return None
+    if any(later < earlier for earlier, later in zip(times, times[1:])): return None # next_departure bisects them.
+    return (date, hour), (array('d', times), tuple(ids), tuple(destinations))
+
+def plan_key(when):
+    return when.strftime('%y%m%d'), when.strftime('%H')
+
+def plan_hours(now):
+    """Start of every hour whose plan can still hold a departure at `now`, delays included."""
+    hour = datetime.fromtimestamp(now - MAX_DELAY_LOOKBACK_S).replace(minute=0, second=0, microsecond=0)
+    end = datetime.fromtimestamp(now) + timedelta(hours=1)
+    hours = []
+    while hour <= end:
+        hours.append(hour); hour += timedelta(hours=1)
+    return hours
+
+class Timetable:
+    """Departures for one station, with plans cached per (date, hour) and delays merged from the change feeds."""
+    def __init__(self, eva_number, client_id, client_secret, get=requests.get):
+        self.eva_number = eva_number
+        self.headers = {"DB-Client-Id": client_id, "DB-Api-Key": client_secret, "accept": "application/xml"}
+        self.get = get
+        self.plans = {}
+        self.changes = {}
+        self.changes_at = 0 # Epoch time of the last successful change-feed refresh.
+        self.last_full_changes = 0
+
+    def fetch(self, path):
+        response = self.get(f"{API_BASE}/{path}", headers=self.headers, timeout=15)
+        response.raise_for_status()
+        return ET.fromstring(response.content)
+
+    def plan(self, when):
+        """Returns the parsed plan for the hour containing `when`, fetching it only the first time."""
+        key = plan_key(when)
+        if key not in self.plans:
+            self.plans[key] = parse_plan(self.fetch(f"plan/{self.eva_number}/{key[0]}/{key[1]}"))
+        return self.plans[key]
+
+    def refresh_changes(self, now):
+        """Pulls the small recent-changes feed, falling back to the full feed when ours may have gaps."""
+        try:
+            if now - self.last_full_changes > FULL_CHANGES_INTERVAL_S or now - self.changes_at > RECENT_CHANGES_WINDOW_S:
+                self.changes = parse_changes(self.fetch(f"fchg/{self.eva_number}"))
+                self.last_full_changes = now
+            else:
+                self.changes.update(parse_changes(self.fetch(f"rchg/{self.eva_number}")))
+            self.changes_at = now
+        except (requests.exceptions.RequestException, ET.ParseError):
+            self.last_full_changes = 0 # Missed an rchg window; the next refresh must be a full one.
+
+    def export(self):
+        """The cached plans and changes as plain JSON data, for the warm-start snapshot and the departures cache."""
+        return {'plans': [[date, hour, list(times), list(ids), list(destinations)] for (date, hour), (times, ids, destinations) in list(self.plans.items())],
+                'changes': dict(self.changes), 'changes_at': self.changes_at, 'last_full_changes': self.last_full_changes}
+
+    def restore(self, data):
+        """Loads what export() produced, dropping anything that has already expired.
+
+        The data comes from files other processes can write, so malformed entries are skipped with a warning.
+        """
+        if not isinstance(data, dict):
+            print(f"Ignoring malformed timetable cache for {self.eva_number}", file=sys.stderr); return
+        plans = data.get('plans', [])
+        for entry in plans if isinstance(plans, list) else []:
+            plan = cached_plan(entry)
+            if plan is None: print(f"Skipping malformed cached plan for {self.eva_number}: {str(entry)[:80]}", file=sys.stderr); continue
+            self.plans[plan[0]] = plan[1]
+        changes_at, last_full_changes = data.get('changes_at', 0), data.get('last_full_changes', 0)
+        if not (is_time(changes_at) and is_time(last_full_changes) and isinstance(data.get('changes', {}), dict)):
+            print(f"Ignoring malformed cached changes for {self.eva_number}", file=sys.stderr)
+        elif changes_at >= self.changes_at: # Keep our own feed if it is newer than the saved one.
+            self.changes.update((stop_id, t) for stop_id, t in data.get('changes', {}).items() if t is None or is_time(t))
+            self.changes_at, self.last_full_changes = changes_at, last_full_changes
+        self.evict(time())
+
+    def plans_around(self, now, refresh=True):
+        """Plans for every hour that can still hold a departure, fetching missing ones unless refresh is False."""
+        if refresh: return [self.plan(hour) for hour in plan_hours(now)]
+        return [self.plans[key] for key in map(plan_key, plan_hours(now)) if key in self.plans]
+
+    def is_fresh(self, now, max_age=CHANGES_MAX_AGE_S):
+        """True if every plan needed right now is cached and the delays are recent enough to use without a refresh."""
+        return now - self.changes_at <= max_age and all(plan_key(hour) in self.plans for hour in plan_hours(now))
+
+    def evict(self, now):
+        """Drops plans and changes for hours that can no longer produce a departure."""
+        oldest = datetime.fromtimestamp(now - MAX_DELAY_LOOKBACK_S) - timedelta(hours=1)
+        for key in [key for key in self.plans if key < plan_key(oldest)]:
+            del self.plans[key]
+        if len(self.changes) > 2000:
+            live = {stop_id for _, ids, _ in self.plans.values() for stop_id in ids}
+            self.changes = {stop_id: t for stop_id, t in self.changes.items() if stop_id in live}
+
+    def next_departure(self, now=None, refresh=True):
+        """Epoch time of the next city-bound departure including delays, or None if there is none.
+
+        With refresh=False only cached plans and changes are used, so it works offline, e.g. right after a warm start.
+        """
+        now = time() if now is None else now
+        plans = self.plans_around(now, refresh)
+        if refresh: self.refresh_changes(now)
+        self.evict(now)
+        best = None
+        for times, ids, destinations in plans:
+            for i in range(bisect_left(times, now - MAX_DELAY_LOOKBACK_S), len(times)):
+                if best is not None and times[i] >= best: break # Delays only push trains later.
+                if destinations[i] in OUTBOUND_DESTINATIONS: continue
+                actual = self.changes.get(ids[i], times[i])
+                if actual is not None and actual >= now and (best is None or actual < best): best = actual
+        return best
+
+    def departures(self, now=None, direction='city', refresh=True):
+        """Upcoming departures in a direction, ordered by actual time, as dicts with their delay; cancelled trains are flagged."""
+        now = time() if now is None else now
+        plans = self.plans_around(now, refresh)
+        if refresh: self.refresh_changes(now)
+        self.evict(now)
+        found = []
+        for times, ids, destinations in plans:
+            for i in range(bisect_left(times, now - MAX_DELAY_LOOKBACK_S), len(times)):
+                if not in_direction(destinations[i], direction): continue
+                actual = self.changes.get(ids[i], times[i])
+                if (times[i] if actual is None else actual) < now: continue
+                found.append({'station': self.eva_number, 'destination': destinations[i], 'planned': times[i], 'departure': times[i] if actual is None else actual,
+                              'delay_minutes': 0 if actual is None else round((actual - times[i]) / 60), 'cancelled': actual is None})
+        found.sort(key=lambda departure: departure['departure'])
+        return found
+
+class DeparturesCache:
+    """Timetable caches of several stations in one JSON file, shared by the server and get_s5.
+
+    Readers take a shared flock on a sidecar lock file and writers an exclusive one; the file itself is replaced
+    atomically, so even a reader that skips the lock never sees half a write. Only the owner may write: the lock file
+    is private and the cache is readable by others, so a server running as root and a user's get_s5 can share it.
+    """
+    def __init__(self, path=DEPARTURES_CACHE):
+        self.path, self.lock_path = path, path + '.lock'
+
+    def lock(self, exclusive):
+        """Returns an open lock file holding the flock; closing it releases the lock.
+
+        A reader that may not open another user's lock file gets a no-op lock and relies on the atomic replace.
+        """
+        try:
+            fd = os.open(self.lock_path, os.O_RDONLY | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        except PermissionError:
+            if exclusive: raise
+            return contextlib.nullcontext()
+        lock = os.fdopen(fd)
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return lock
+
+    def read(self):
+        """Station number -> Timetable.export() data. Caller holds the lock."""
+        try:
+            with open(self.path, encoding='utf-8') as f: data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            return {} # A corrupt cache is rebuilt on the next write.
+        return data if isinstance(data, dict) else {}
+
+    def write(self, data):
+        """Replaces the cache file atomically. Caller holds the exclusive lock."""
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f: json.dump(data, f, separators=(',', ':'), ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def store(self, timetable):
+        """Merges one station's current cache into the file."""
+        with self.lock(exclusive=True):
+            data = self.read()
+            data[timetable.eva_number] = timetable.export()
+            self.write(data)
@@ -1,443 +1,885 @@
-import RPi.GPIO as GPIO
-from gpiozero import LED
-from time import sleep, time
+from time import sleep, time, monotonic, perf_counter
 import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import urlparse, parse_qs
+import queue
+import asyncio
+import gzip
+import hashlib
+import math
+from urllib.parse import urlencode
 import json
-import random
-from socketserver import ThreadingMixIn
 import sys
 import os
-import requests
-import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta
+from datetime import datetime
 import socket
+import select
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from timetable import Timetable, DeparturesCache
+from fetcher import FetchEngine
+from lights import create_light_backend, COLOR_MASKS, RED, YELLOW, GREEN
+from programs import BUILTIN_PROGRAMS, ProgramError, ProgramRunner, compile_program
+from fleet import FleetCoordinator, FleetFollower
+from history import History
+from metrics import Counter, Histogram, Callback, TimedLock, render_metrics
+from web import HTTPServer, Response, BadRequest, json_response, error_response
+
+# --- Instrumentation (served on /metrics) ---
+LOCK_WAIT = Histogram('traffic_light_state_lock_wait_seconds', "Time spent waiting to acquire state_lock.", labelnames=('thread',))
+LOCK_HOLD = Histogram('traffic_light_state_lock_hold_seconds', "Time state_lock was held per acquisition.", labelnames=('thread',))
+CONTROLLER_LATENESS = Histogram('traffic_light_controller_lateness_seconds', "How late the controller woke up relative to its deadline.")
+HTTP_REQUESTS = Histogram('traffic_light_http_request_duration_seconds', "Time until the HTTP handler returned its response; streamed bodies are not included.", labelnames=('path',))
+LIGHT_TRANSITIONS = Counter('traffic_light_transitions_total', "Changes of the displayed light state.")
+PIN_WRITES = Counter('traffic_light_pin_writes_total', "Individual pin level changes sent to the light backend.")
+HTTP_PATHS = frozenset(['/', '/status', '/events', '/metrics', '/api/commands', '/api/programs', '/history'])
 
 # --- Global State & Threading Resources ---
-state_lock = threading.Lock()
-target_mode = "auto"
-target_manual_color = "off"
+class State(namedtuple('State', 'version target_mode manual_color mode color s_bahn_minutes weather iracing_flag space_weather traffic race_step')):
+    """Immutable snapshot of everything the controller and the clients look at. Writers swap in a new one via publish();
+    readers take `state` once and use that copy, without locking. The dict fields are never mutated after publishing."""
+    __slots__ = ()
+
+    def status(self):
+        """The client-facing status dict."""
+        return {'color': self.color, 'mode': self.mode, 's_bahn_minutes': self.s_bahn_minutes, 'weather': self.weather, 'race_step': self.race_step, 'space_weather': self.space_weather, 'traffic': self.traffic}
+
+state = State(version=0, target_mode='auto', manual_color='off', mode='auto', color='unknown', s_bahn_minutes=-1, weather={}, iracing_flag='black', space_weather={}, traffic={}, race_step=0)
+state_lock = TimedLock(LOCK_WAIT, LOCK_HOLD) # Serializes writers' swaps of `state` and `programs`; readers never take it.
+# Owned by the controller thread: what the light shows right now. Everyone else reads state.mode and state.color.
 current_mode = "auto"
 current_color = "unknown"
-last_state_change_time = 0
-s_bahn_minutes_away = -1
-weather_status = {}
-iracing_light_status = "black"
-space_weather_status = {}
-traffic_status = {}
-
-# --- CORRECTED: Mode-specific state moved to global scope ---
-mode_state = {
-    'next_auto_state': 'green', 'sos_index': 0, 'race_step': 0,
-    'sos_pattern': [
-        {'state': 'all_on', 'duration': 0.2}, {'state': 'off', 'duration': 0.2},{'state': 'all_on', 'duration': 0.2}, {'state': 'off', 'duration': 0.2},{'state': 'all_on', 'duration': 0.2}, {'state': 'off', 'duration': 0.4},
-        {'state': 'all_on', 'duration': 0.6}, {'state': 'off', 'duration': 0.2},{'state': 'all_on', 'duration': 0.6}, {'state': 'off', 'duration': 0.2},{'state': 'all_on', 'duration': 0.6}, {'state': 'off', 'duration': 0.4},
-        {'state': 'all_on', 'duration': 0.2}, {'state': 'off', 'duration': 0.2},{'state': 'all_on', 'duration': 0.2}, {'state': 'off', 'duration': 0.2},{'state': 'all_on', 'duration': 0.2}, {'state': 'off', 'duration': 1.5},
-    ]
-}
 
-# --- GPIO Setup ---
-GPIO.setmode(GPIO.BCM)
-red = LED(22, active_high=False)
-yellow = LED(27, active_high=False)
-green = LED(17, active_high=False)
-all_lights = [red, yellow, green]
+# --- Controller input ---
+controller_inputs = queue.SimpleQueue() # ('commands', batch), ('fleet', mode, mask) or ('follow', following), drained by the controller.
+controller_wakeup = threading.Event()
 
-# --- Core Light Control Helper Function (Bug Fixed) ---
+# --- Versioned status snapshot for push clients ---
+http_loop = None
+version_event = None # asyncio.Event on http_loop, swapped for a fresh one on every version bump.
+STREAM_KEEPALIVE_S = 15
+LONG_POLL_TIMEOUT_S = 25
+
+# --- Signal History (served on /history) ---
+# Aggregation per signal when older data is downsampled: 'color' is a bit mask, so it keeps the last value.
+history = History({'s_bahn_minutes': 'mean', 'temperature': 'mean', 'kp_index': 'mean', 'traffic_delay': 'mean', 'color': 'last', 'light_changes': 'sum'})
+HISTORY_DEFAULT_SPAN_S = 3600
+HISTORY_CHUNK_POINTS = 512
+
+# --- Light Backend Setup ---
+light_backend = create_light_backend()
+
+# --- Core Light Control Helper Function ---
 def set_light_state(color_to_set):
-    """Sets the physical light state. This is the only function that touches the GPIO pins."""
+    """Sets the physical light state. This is the only function that touches the light backend, or hands it to the fleet coordinator.
+
+    Runs on the controller thread only, with no lock held.
+    """
     global current_color
     if current_color == color_to_set:
         return
-    for light in all_lights:
-        light.off()
-    if color_to_set == "red": red.on()
-    elif color_to_set == "yellow": yellow.on()
-    elif color_to_set == "green": green.on()
-    elif color_to_set == "red_and_yellow": red.on(); yellow.on()
-    elif color_to_set == "all_on": red.on(); yellow.on(); green.on()
-    elif color_to_set == "green-yellow": green.on(); yellow.on()
-    
+    mask = COLOR_MASKS.get(color_to_set, 0) # Unknown names, like 'off', switch everything off.
+    PIN_WRITES.inc(amount=bin(COLOR_MASKS.get(current_color, 0) ^ mask).count('1'))
+    LIGHT_TRANSITIONS.inc()
+    if fleet is not None and fleet.role == 'coordinator': fleet.publish(mask, current_mode) # Written locally at the fleet-wide apply time.
+    else: light_backend.write(mask)
     current_color = color_to_set
+    now = time()
+    history.record('color', now, mask)
+    history.record('light_changes', now, 1)
 
-# --- Background Data Fetching Threads ---
-def s_bahn_monitor():
-    """Runs in a separate thread to periodically fetch S-Bahn data."""
-    global s_bahn_minutes_away
-    client_id, client_secret = os.getenv("DB_CLIENT_ID"), os.getenv("DB_CLIENT_SECRET")
-    ottobrunn_eva = "8004733"
-    if not client_id or not client_secret:
-        print("S-Bahn Monitor disabled: DB API keys not set.", file=sys.stderr)
-        return
-    while True:
-        minutes = get_next_train_minutes(ottobrunn_eva, client_id, client_secret)
-        with state_lock:
-            s_bahn_minutes_away = minutes if minutes is not None else -1
-        sleep(30)
-
-def weather_monitor():
-    """Runs in a separate thread to fetch weather data every 15 minutes."""
-    global weather_status
-    api_key = os.getenv("OWM_API_KEY")
+def publish(**changes):
+    """Swaps in a copy of the state with `changes` and the next version, and wakes stream clients. No-op if nothing changed.
+
+    The lock only orders concurrent writers for the few microseconds of the swap; it is never held across I/O.
+    """
+    global state
+    with state_lock:
+        if all(getattr(state, key) == value for key, value in changes.items()): return
+        state = state._replace(version=state.version + 1, **changes)
+    if http_loop is not None: http_loop.call_soon_threadsafe(signal_new_version)
+
+# --- Upstream Data Sources (run by the shared fetch engine) ---
+fetch_engine = FetchEngine()
+OTTOBRUNN_EVA = "8004733"
+WEATHER_API_URL = os.getenv("OWM_API_URL", "https://api.openweathermap.org/data/2.5/weather")
+SPACE_WEATHER_URL = os.getenv("NOAA_KP_URL", "https://services.swpc.noaa.gov/products/noaa-planetary-k-index.json")
+DISTANCE_MATRIX_URL = os.getenv("GOOGLE_DISTANCE_MATRIX_URL", "https://maps.googleapis.com/maps/api/distancematrix/json")
+s_bahn_timetable = None
+departures_cache = DeparturesCache()
+
+def fetch_s_bahn(engine):
+    """Next city-bound S-Bahn from Ottobrunn, in minutes, or -1 if none is scheduled."""
+    departure = s_bahn_timetable.next_departure()
+    try:
+        departures_cache.store(s_bahn_timetable) # Lets get_s5 answer from our fetches instead of spending quota.
+    except OSError as e:
+        print(f"Could not update the departures cache: {e}", file=sys.stderr)
+    return int((departure - time()) / 60) if departure is not None else -1
+
+def fetch_weather(engine):
+    """Current temperature and condition for Hohenbrunn from OpenWeatherMap."""
     lat, lon = "48.0667", "11.7167" # Coordinates for Hohenbrunn
-    WEATHER_API_URL = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={api_key}&units=metric"
-    if not api_key:
-        print("Biergarten Monitor disabled: OWM_API_KEY not set.", file=sys.stderr)
-        return
-    while True:
-        try:
-            response = requests.get(WEATHER_API_URL, timeout=15)
-            response.raise_for_status()
-            data = response.json()
-            with state_lock:
-                weather_status = {'temp': data.get('main', {}).get('temp'), 'condition': data.get('weather', [{}])[0].get('main')}
-        except Exception as e:
-            print(f"Error fetching weather data: {e}", file=sys.stderr)
-            with state_lock: weather_status = {}
-        sleep(900)
-
-def space_weather_monitor():
-    """Runs in a separate thread to fetch planetary K-index data every 15 minutes."""
-    global space_weather_status
-    SPACE_WEATHER_URL = "https://services.swpc.noaa.gov/products/noaa-planetary-k-index.json"
-    while True:
-        print("Space Weather Monitor: Fetching K-index data...")
+    data = engine.get(f"{WEATHER_API_URL}?lat={lat}&lon={lon}&appid={os.getenv('OWM_API_KEY')}&units=metric").json()
+    return {'temp': data.get('main', {}).get('temp'), 'condition': data.get('weather', [{}])[0].get('main')}
+
+def fetch_space_weather(engine):
+    """Latest planetary K-index from NOAA SWPC."""
+    print("Space Weather Monitor: Fetching K-index data...")
+    data = engine.get(SPACE_WEATHER_URL).json()
+    kp_index = int(float(data[-1][1]))
+    condition = "Quiet"
+    if kp_index >= 5: condition = "Storm"
+    elif kp_index == 4: condition = "Active"
+    print(f"Space Weather Monitor: Kp-index is {kp_index} ({condition}).")
+    return {'kp_index': kp_index, 'condition': condition}
+
+DEFAULT_STAU_ROUTES = [
+    {"name": "commute", "origin": "Nelkenstraße 24A, 85521 Hohenbrunn, Germany", "destination": "Landaubogen 1, 81373 München, Germany", "weight": 2},
+    {"name": "center", "origin": "Hohenbrunn, Germany", "destination": "Marienplatz, Munich, Germany", "weight": 1},
+    {"name": "north", "origin": "Hohenbrunn, Germany", "destination": "BMW Welt, Munich, Germany", "weight": 1}
+]
+MAX_MATRIX_PLACES = 25 # Google's cap on origins, and on destinations, per Distance Matrix request.
+ROUTE_CACHE_MAX_AGE_S = 1800
+TRAFFIC_SMOOTHING = 0.4 # Weight of a new reading in the moving average of the delay.
+route_cache = {}
+route_executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix='fetch') # Matches the fetch engine's connection pool.
+smoothed_traffic_delay = None
+
+def load_stau_routes():
+    """Routes from the JSON file named by STAU_ROUTES_FILE, or the built-in ones."""
+    path = os.getenv("STAU_ROUTES_FILE")
+    if not path: return DEFAULT_STAU_ROUTES
+    with open(path, encoding='utf-8') as f:
+        return [dict(route, weight=route.get('weight', 1)) for route in json.load(f)]
+
+def matrix_batches(routes):
+    """Splits routes into Distance Matrix requests with one origin and up to MAX_MATRIX_PLACES destinations, or the
+    other way round, whichever takes fewer requests. Every billed element is then a configured route."""
+    by_origin, by_destination = {}, {}
+    for route in routes:
+        by_origin.setdefault(route['origin'], []).append(route)
+        by_destination.setdefault(route['destination'], []).append(route)
+    for group in (by_origin if len(by_origin) <= len(by_destination) else by_destination).values():
+        for start in range(0, len(group), MAX_MATRIX_PLACES): yield group[start:start + MAX_MATRIX_PLACES]
+
+def fetch_route_batch(engine, batch, api_key):
+    """Requests one batch from matrix_batches() and stores each of its routes in route_cache."""
+    origins = list(dict.fromkeys(route['origin'] for route in batch))
+    destinations = list(dict.fromkeys(route['destination'] for route in batch))
+    query = urlencode({'origins': '|'.join(origins), 'destinations': '|'.join(destinations), 'departure_time': 'now', 'key': api_key})
+    data = engine.get(f"{DISTANCE_MATRIX_URL}?{query}").json()
+    if data.get('status') != 'OK':
+        print(f"Stau Monitor: Google API error: {data.get('status')}", file=sys.stderr); return
+    for route in batch:
+        element = data['rows'][origins.index(route['origin'])]['elements'][destinations.index(route['destination'])]
+        if element.get('status') != 'OK' or 'duration_in_traffic' not in element:
+            print(f"Stau Monitor: no traffic data for route {route['name']}: {element.get('status')}", file=sys.stderr); continue
+        duration_sec, duration_in_traffic_sec = element['duration']['value'], element['duration_in_traffic']['value']
+        delay_percent = ((duration_in_traffic_sec - duration_sec) / duration_sec) * 100 if duration_sec > 0 else 0
+        route_cache[route['name']] = (delay_percent, element['duration_in_traffic']['text'], time())
+
+def fetch_route_matrix(engine, routes, api_key):
+    """Fills route_cache for all routes, requesting only the origin/destination pairs the routes use.
+
+    Batches run concurrently, so a cycle takes one round trip, and a slow or failing batch only costs its own routes.
+    """
+    futures = [(route_executor.submit(fetch_route_batch, engine, batch, api_key), batch) for batch in matrix_batches(routes)]
+    for future, batch in futures:
         try:
-            response = requests.get(SPACE_WEATHER_URL, timeout=15)
-            response.raise_for_status()
-            data = response.json()
-            latest_data = data[-1]
-            kp_index = int(float(latest_data[1]))
-            condition = "Quiet"
-            if kp_index >= 5: condition = "Storm"
-            elif kp_index == 4: condition = "Active"
-            with state_lock:
-                space_weather_status = {'kp_index': kp_index, 'condition': condition}
-                print(f"Space Weather Monitor: Kp-index is {kp_index} ({condition}).")
+            future.result()
         except Exception as e:
-            print(f"Error fetching space weather data: {e}", file=sys.stderr)
-            with state_lock: space_weather_status = {}
-        sleep(900)
+            print(f"Stau Monitor: error fetching routes {', '.join(route['name'] for route in batch)}: {e}", file=sys.stderr)
 
-def traffic_monitor():
-    """Runs in a separate thread to fetch live traffic data for multiple key routes."""
-    global traffic_status
+def fetch_traffic(engine):
+    """Weighted, smoothed traffic delay over the configured routes plus the commute time, from batched Distance Matrix calls."""
+    global smoothed_traffic_delay
     api_key = os.getenv("GOOGLE_MAPS_API_KEY")
-    if not api_key:
-        print("Stau Monitor disabled: GOOGLE_MAPS_API_KEY not set.", file=sys.stderr)
-        return
-    routes = [
-        {"name": "commute", "origin": "Nelkenstraße 24A, 85521 Hohenbrunn, Germany", "destination": "Landaubogen 1, 81373 München, Germany"},
-        {"name": "center", "origin": "Hohenbrunn, Germany", "destination": "Marienplatz, Munich, Germany"},
-        {"name": "north", "origin": "Hohenbrunn, Germany", "destination": "BMW Welt, Munich, Germany"}
-    ]
-    while True:
-        print("Stau Monitor: Fetching traffic data for all routes...")
-        delays = []
-        commute_time_text = "N/A"
-        for route in routes:
-            try:
-                url = f"https://maps.googleapis.com/maps/api/directions/json?origin={route['origin']}&destination={route['destination']}&key={api_key}&departure_time=now"
-                response = requests.get(url, timeout=15)
-                response.raise_for_status()
-                data = response.json()
-                if data.get('status') == 'OK':
-                    leg = data['routes'][0]['legs'][0]
-                    duration_sec = leg['duration']['value']
-                    duration_in_traffic_sec = leg['duration_in_traffic']['value']
-                    delay_percent = ((duration_in_traffic_sec - duration_sec) / duration_sec) * 100 if duration_sec > 0 else 0
-                    delays.append(delay_percent)
-                    if route['name'] == 'commute':
-                        commute_time_text = leg['duration_in_traffic']['text']
-                else:
-                    print(f"Stau Monitor: Google API error for route {route['name']}: {data.get('status')}")
-            except Exception as e:
-                print(f"Error fetching traffic data for route {route['name']}: {e}", file=sys.stderr)
-        with state_lock:
-            if delays:
-                avg_delay = sum(delays) / len(delays)
-                traffic_status = {'avg_delay': avg_delay, 'commute_time': commute_time_text}
-                print(f"Stau Monitor: Average delay is {avg_delay:.0f}%. Your commute time is {commute_time_text}.")
-            else:
-                traffic_status = {}
-        sleep(600)
-
-def get_next_train_minutes(eva_number, client_id, client_secret):
-    """Fetches and parses train data from the DB API. Logic now matches the working script."""
-    PLAN_API_URL = "https://apis.deutschebahn.com/db-api-marketplace/apis/timetables/v1/plan"
-    OUTBOUND_DESTINATIONS = ["Kreuzstraße", "Aying", "Höhenkirchen-Siegertsbrunn", "Dürrnhaar", "Hohenbrunn", "Wächterhof"]
-    headers = {"DB-Client-Id": client_id, "DB-Api-Key": client_secret, "accept": "application/xml"}
-    now = datetime.now()
-    all_stops = []
-    for i in range(2):
-        check_time = now + timedelta(hours=i)
-        date, hour = check_time.strftime('%y%m%d'), check_time.strftime('%H')
-        try:
-            response = requests.get(f"{PLAN_API_URL}/{eva_number}/{date}/{hour}", headers=headers, timeout=15)
-            response.raise_for_status()
-            root = ET.fromstring(response.content)
-            all_stops.extend(root.findall('s'))
-        except requests.exceptions.RequestException: return None
-    upcoming_departures_minutes = []
-    for stop in all_stops:
-        try:
-            # This logic matches the user's working script.
-            # It finds the final destination and filters out outbound trains.
-            path_string = stop.find('.//dp').get('ppth')
-            destination = path_string.split('|')[-1]
-            if destination in OUTBOUND_DESTINATIONS: continue
-            
-            departure_time_raw = stop.find('.//dp').get('pt')
-            departure_dt = datetime.strptime(departure_time_raw, '%y%m%d%H%M')
-            if departure_dt < now: continue
-            minutes_until = int((departure_dt - now).total_seconds() / 60)
-            upcoming_departures_minutes.append(minutes_until)
-        except (AttributeError, IndexError): continue
-    return min(upcoming_departures_minutes) if upcoming_departures_minutes else None
+    routes = load_stau_routes()
+    for name in set(route_cache) - {route['name'] for route in routes}: del route_cache[name] # Routes removed from the config.
+    print("Stau Monitor: Fetching traffic data for all routes...")
+    try:
+        fetch_route_matrix(engine, routes, api_key)
+    except Exception as e:
+        print(f"Error fetching traffic data: {e}", file=sys.stderr)
+    # Routes that failed this round fall back to their cached reading while it is still reasonably fresh.
+    fresh = [(route, route_cache[route['name']]) for route in routes if route['name'] in route_cache and time() - route_cache[route['name']][2] < ROUTE_CACHE_MAX_AGE_S]
+    if not fresh:
+        raise RuntimeError("no route returned traffic data")
+    raw_delay = sum(route['weight'] * cached[0] for route, cached in fresh) / sum(route['weight'] for route, _ in fresh)
+    smoothed_traffic_delay = raw_delay if smoothed_traffic_delay is None else smoothed_traffic_delay + TRAFFIC_SMOOTHING * (raw_delay - smoothed_traffic_delay)
+    commute_time_text = next((cached[1] for route, cached in fresh if route['name'] == 'commute'), "N/A")
+    print(f"Stau Monitor: Average delay is {smoothed_traffic_delay:.0f}% ({raw_delay:.0f}% now). Your commute time is {commute_time_text}.")
+    return {'avg_delay': smoothed_traffic_delay, 'raw_delay': raw_delay, 'commute_time': commute_time_text, 'routes': {route['name']: round(cached[0]) for route, cached in fresh}}
+
+Callback('traffic_light_source_age_seconds', "Age of the last good value from each upstream source.", 'gauge', ('source',), lambda: {(name,): age for name, age in fetch_engine.ages().items()})
+
+def update_monitor(name, value, fetched_at):
+    """Publishes a fresh value from a fetch worker and lets the controller react to it."""
+    if name == 's_bahn': publish(s_bahn_minutes=value)
+    else: publish(**{name: dict(value, fetched_at=fetched_at)}) # weather, space_weather and traffic share their state field's name.
+    wake_controller()
+    record_history(name, value, time() if fetched_at is None else fetched_at)
+
+def record_history(name, value, t):
+    if name == 's_bahn': history.record('s_bahn_minutes', t, value if value >= 0 else None)
+    elif name == 'weather': history.record('temperature', t, value.get('temp'))
+    elif name == 'space_weather': history.record('kp_index', t, value.get('kp_index'))
+    elif name == 'traffic': history.record('traffic_delay', t, value.get('avg_delay'))
+
+# --- Demand-Driven Polling Policy ---
+# Which mode displays each source, and how often it is polled while that mode is on.
+SOURCE_MODES = {'s_bahn': 's_bahn', 'weather': 'biergarten', 'space_weather': 'space', 'traffic': 'stau'}
+POLL_INTERVALS = {'s_bahn': 30, 'weather': 900, 'space_weather': 900, 'traffic': 600}
+S_BAHN_FAST_POLL_S = 10 # While a train is close, its delay matters minute by minute.
+BACKGROUND_POLL_FACTOR = 4
+PAID_SOURCES = frozenset(['s_bahn', 'traffic']) # Never fetched unless their mode is on.
+CONSUMER_GRACE_S = 60
+stream_clients = 0
+last_status_poll = float('-inf')
+
+def status_consumers_connected():
+    return stream_clients > 0 or monotonic() - last_status_poll < CONSUMER_GRACE_S
+
+def poll_interval(name):
+    """Seconds until a source should be fetched again given what is on display, or None to suspend it."""
+    if fleet_following: return None # The coordinator fetches for the whole fleet.
+    current = state
+    if SOURCE_MODES[name] in (current.mode, current.target_mode):
+        if name == 's_bahn' and 0 <= current.s_bahn_minutes < 12: return S_BAHN_FAST_POLL_S
+        return POLL_INTERVALS[name]
+    # Free sources keep ticking slowly while someone watches the dashboard; switching modes refreshes stale data anyway.
+    if name in PAID_SOURCES or not status_consumers_connected(): return None
+    return POLL_INTERVALS[name] * BACKGROUND_POLL_FACTOR
+
+def register_source(name, fetch):
+    value, fetched_at = restored_sources.get(name, (None, None))
+    fetch_engine.register(name, fetch, lambda: poll_interval(name), lambda value, fetched_at: update_monitor(name, value, fetched_at), value, fetched_at)
+
+def start_monitors():
+    """Registers every configured upstream source with the fetch engine and starts it."""
+    global s_bahn_timetable
+    client_id, client_secret = os.getenv("DB_CLIENT_ID"), os.getenv("DB_CLIENT_SECRET")
+    if client_id and client_secret:
+        s_bahn_timetable = Timetable(OTTOBRUNN_EVA, client_id, client_secret, get=fetch_engine.get)
+        restore_timetable(s_bahn_timetable)
+        register_source('s_bahn', fetch_s_bahn)
+    else: print("S-Bahn Monitor disabled: DB API keys not set.", file=sys.stderr)
+    if os.getenv("OWM_API_KEY"): register_source('weather', fetch_weather)
+    else: print("Biergarten Monitor disabled: OWM_API_KEY not set.", file=sys.stderr)
+    register_source('space_weather', fetch_space_weather)
+    if os.getenv("GOOGLE_MAPS_API_KEY"): register_source('traffic', fetch_traffic)
+    else: print("Stau Monitor disabled: GOOGLE_MAPS_API_KEY not set.", file=sys.stderr)
+    fetch_engine.start()
 
 # --- iRacing UDP Listener ---
+# Binary telemetry packet: magic "TL", format version, uint32 sequence number, flag index into TELEMETRY_FLAGS.
+# Plain-text flag names without a sequence number are still accepted from older senders.
+IRACING_UDP_PORT = int(os.getenv("IRACING_UDP_PORT", 9001))
+TELEMETRY_PACKET = struct.Struct('!2sBIB')
+TELEMETRY_MAGIC, TELEMETRY_VERSION = b'TL', 1
+TELEMETRY_FLAGS = ('black', 'red', 'yellow', 'green', 'green-yellow', 'all_on')
+TELEMETRY_TEXT_FLAGS = frozenset(TELEMETRY_FLAGS)
+TELEMETRY_REORDER_WINDOW = 256 # Packets this far behind the newest are late duplicates; further behind means the sender restarted.
+TELEMETRY_RESET_S = 2 # A sender silent this long, or one from a new address, may have restarted its counter low.
+telemetry_stats = {'received': 0, 'dropped': 0, 'coalesced': 0}
+Callback('traffic_light_udp_packets_total', "Telemetry packets by outcome; 'received' counts every datagram.", 'counter', ('result',), lambda: {(result,): count for result, count in telemetry_stats.items()})
+
+def encode_telemetry(sequence, flag):
+    """Builds a binary telemetry packet, for senders and tests."""
+    return TELEMETRY_PACKET.pack(TELEMETRY_MAGIC, TELEMETRY_VERSION, sequence & 0xFFFFFFFF, TELEMETRY_FLAGS.index(flag))
+
+def decode_telemetry(data):
+    """Returns (sequence or None, flag) for a binary or legacy text packet, or None if it is malformed."""
+    if len(data) == TELEMETRY_PACKET.size and data[:2] == TELEMETRY_MAGIC:
+        _, version, sequence, code = TELEMETRY_PACKET.unpack(data)
+        return (sequence, TELEMETRY_FLAGS[code]) if version == TELEMETRY_VERSION and code < len(TELEMETRY_FLAGS) else None
+    flag = data.strip().decode('ascii', 'replace')
+    return (None, flag) if flag in TELEMETRY_TEXT_FLAGS else None
+
+def is_stale_sequence(sequence, last_sequence):
+    behind = (last_sequence - sequence) % 2**32
+    return behind <= TELEMETRY_REORDER_WINDOW
+
 def iracing_udp_listener():
-    """Runs a UDP server to listen for real-time iRacing data."""
-    global iracing_light_status
-    host, port = "0.0.0.0", 9001
+    """Runs a UDP server for real-time iRacing flags, draining each burst and applying only the newest packet."""
+    host, port = "0.0.0.0", IRACING_UDP_PORT
+    last_sequence, last_sender, last_accepted = None, None, float('-inf')
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
         sock.bind((host, port))
+        sock.setblocking(False)
         print(f"iRacing UDP listener started on port {port}")
         while True:
-            try:
-                data, addr = sock.recvfrom(1024)
-                color = data.decode('utf-8').strip()
-                valid_commands = ['red', 'yellow', 'green', 'black', 'green-yellow', 'all_on']
-                if color in valid_commands:
-                    with state_lock:
-                        iracing_light_status = color
-            except Exception as e:
-                print(f"Error in iRacing UDP listener: {e}")
+            select.select([sock], [], [])
+            newest, accepted = None, 0
+            while True:
+                try:
+                    data, addr = sock.recvfrom(1024)
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    print(f"Error in iRacing UDP listener: {e}"); break
+                telemetry_stats['received'] += 1
+                packet = decode_telemetry(data)
+                now = monotonic()
+                if addr != last_sender or now - last_accepted > TELEMETRY_RESET_S: last_sequence = None # Start over with this sender.
+                if packet is None or (packet[0] is not None and last_sequence is not None and is_stale_sequence(packet[0], last_sequence)):
+                    telemetry_stats['dropped'] += 1; continue
+                if packet[0] is not None: last_sequence = packet[0]
+                last_sender, last_accepted = addr, now
+                newest, accepted = packet[1], accepted + 1
+            if newest is None: continue
+            telemetry_stats['coalesced'] += accepted - 1
+            publish(iracing_flag=newest)
+            wake_controller()
+
+# --- Light Programs ---
+# Signal readers that program conditions and signal colors are compiled against. All run on the controller thread and
+# read the published state without locking; 'color' is the controller's own view of the light.
+PROGRAM_SIGNALS = {
+    's_bahn_minutes': lambda: None if state.s_bahn_minutes == -1 else state.s_bahn_minutes,
+    'temperature': lambda: state.weather.get('temp'),
+    'weather_condition': lambda: state.weather.get('condition'),
+    'kp_index': lambda: state.space_weather.get('kp_index'),
+    'traffic_delay': lambda: state.traffic.get('avg_delay'),
+    'hour': lambda: datetime.now().hour,
+    'iracing_flag': lambda: 'off' if state.iracing_flag == 'black' else state.iracing_flag,
+    'manual_color': lambda: state.manual_color,
+    'color': lambda: current_color,
+}
+MAX_USER_PROGRAMS = 32
+# Copy-on-write like `state`: install_program swaps in a new dict, so readers can iterate `programs` without locking.
+programs = {source['name']: compile_program(source, PROGRAM_SIGNALS, builtin=True) for source in BUILTIN_PROGRAMS}
+program_runner = ProgramRunner(set_light_state)
+
+def install_program(source):
+    """Compiles and registers a user program, replacing an earlier upload of the same name.
+
+    If that program is running, the controller notices the new object and restarts it.
+    """
+    global programs
+    program = compile_program(source, PROGRAM_SIGNALS)
+    with state_lock:
+        existing = programs.get(program.name)
+        if existing is not None and existing.builtin: raise ProgramError(f"cannot replace built-in program {program.name!r}")
+        if existing is None and sum(not p.builtin for p in programs.values()) >= MAX_USER_PROGRAMS:
+            raise ProgramError(f"at most {MAX_USER_PROGRAMS} user programs")
+        programs = dict(programs, **{program.name: program})
+    wake_controller()
+    return program
 
 # --- Main Controller Thread & Mode Logic ---
+def wake_controller():
+    """Interrupts the controller's wait so it re-evaluates immediately. Safe to call from any thread."""
+    controller_wakeup.set()
+
+def submit(*item):
+    """Queues an input for the controller and wakes it. The caller never waits for the controller or the light."""
+    controller_inputs.put(item)
+    controller_wakeup.set()
+
+def drain_inputs():
+    """Applies every queued input in order. Returns True if the running program must restart."""
+    global current_mode
+    restart = False
+    while True:
+        try:
+            item = controller_inputs.get_nowait()
+        except queue.Empty:
+            return restart
+        if item[0] == 'commands':
+            apply_commands(item[1])
+        elif item[0] == 'fleet':
+            _, mode, mask = item
+            current_mode = mode
+            if mode in programs: publish(target_mode=mode) # Resumed if the coordinator goes silent.
+            set_light_state(FLEET_MASK_COLORS.get(mask, 'off'))
+        elif item[0] == 'follow':
+            restart = not item[1]
+
+def enter_mode(mode, now):
+    """Starts the mode's program from its first step and returns its first deadline."""
+    global current_mode
+    current_mode = mode
+    deadline = program_runner.start(programs[mode], now)
+    if fleet is not None and fleet.role == 'coordinator': fleet.publish(COLOR_MASKS.get(current_color, 0), mode) # Mode changes that keep the color.
+    fetch_engine.replan() # Refresh what the new mode shows if it is stale, and stop polling what it doesn't.
+    return deadline
+
 def traffic_light_controller():
-    """The single authority for all hardware changes."""
-    global current_mode, last_state_change_time, mode_state
-    
-    with state_lock:
-        set_light_state("green")
-        last_state_change_time = time()
+    """The single authority for all hardware changes. Sleeps until the program's next step deadline or a wakeup.
+
+    On a fleet follower it stays idle while the coordinator is heard, and resumes the last mirrored mode otherwise.
+    It holds no lock while it waits, steps or writes the light, so readers and HTTP load never delay a transition.
+    A program that fails is replaced by idle rather than taking the only thread that drives the light down with it.
+    """
+    deadline = None
+    if not fleet_following: wake_controller() # No program is loaded yet, so the first pass enters the target mode.
     while True:
-        loop_sleep = 0.2
-        with state_lock:
-            if current_mode != target_mode:
-                current_mode = target_mode
-                last_state_change_time = time()
-                if current_mode == 'auto': set_light_state('red'); mode_state['next_auto_state'] = 'red_and_yellow'
-                elif current_mode == 'sos': mode_state['sos_index'] = 0; set_light_state('off')
-                elif current_mode == 'racing': mode_state['race_step'] = 0; set_light_state('off')
-                elif current_mode == 'idle': set_light_state('off')
-            if current_mode == 'manual':
-                set_light_state(target_manual_color)
-            
-            elapsed = time() - last_state_change_time
-            
-            mode_handlers = {
-                "auto": handle_auto_mode, "party": handle_party_mode, "emergency": handle_emergency_mode,
-                "sos": handle_sos_mode, "s_bahn": handle_s_bahn_mode, "biergarten": handle_biergarten_mode,
-                "racing": handle_racing_mode, "space": handle_space_mode, "stau": handle_stau_mode
-            }
-            handler = mode_handlers.get(current_mode)
-            if handler:
-                custom_sleep = handler(elapsed)
-                if custom_sleep is not None:
-                    loop_sleep = custom_sleep
-        sleep(loop_sleep)
-
-def handle_auto_mode(elapsed):
-    global last_state_change_time, mode_state
-    if current_color == 'green' and elapsed > 20: set_light_state('yellow'); mode_state['next_auto_state'] = 'red'; last_state_change_time = time()
-    elif current_color == 'yellow' and elapsed > 3: set_light_state(mode_state['next_auto_state']); last_state_change_time = time()
-    elif current_color == 'red' and elapsed > 20: set_light_state('red_and_yellow'); mode_state['next_auto_state'] = 'green'; last_state_change_time = time()
-    elif current_color == 'red_and_yellow' and elapsed > 2: set_light_state(mode_state['next_auto_state']); last_state_change_time = time()
-
-def handle_party_mode(elapsed): set_light_state(random.choice(['red', 'yellow', 'green', 'off'])); return 0.08
-def handle_emergency_mode(elapsed): set_light_state('yellow' if current_color != 'yellow' else 'off'); return 0.5
-def handle_sos_mode(elapsed):
-    global last_state_change_time, mode_state
-    current_step = mode_state['sos_pattern'][mode_state['sos_index']]
-    if elapsed > current_step['duration']:
-        mode_state['sos_index'] = (mode_state['sos_index'] + 1) % len(mode_state['sos_pattern']); set_light_state(mode_state['sos_pattern'][mode_state['sos_index']]['state']); last_state_change_time = time()
-def handle_s_bahn_mode(elapsed):
-    minutes = s_bahn_minutes_away
-    if minutes == -1: set_light_state('red' if current_color != 'red' else 'off'); return 0.5
-    elif minutes < 9: set_light_state('red')
-    elif minutes == 9: set_light_state('yellow' if current_color != 'yellow' else 'off'); return 0.5
-    elif minutes <= 12: set_light_state('yellow')
-    else: set_light_state('green')
-def handle_biergarten_mode(elapsed):
-    temp, condition, hour = weather_status.get('temp'), weather_status.get('condition'), datetime.now().hour
-    if temp is None or condition is None: set_light_state('red' if current_color != 'red' else 'off'); return 0.5
-    elif hour < 16 or temp < 15 or "Rain" in condition or "Snow" in condition: set_light_state('red')
-    elif temp < 18 or "Clouds" in condition: set_light_state('yellow')
-    else: set_light_state('green')
-
-def handle_racing_mode(elapsed):
-    global last_state_change_time, mode_state
-    step = mode_state['race_step']
-    if step < 4:
-        if step == 0 and elapsed > 1: set_light_state('red'); mode_state['race_step'] += 1; last_state_change_time = time()
-        elif step == 1 and elapsed > 1: set_light_state('red_and_yellow'); mode_state['race_step'] += 1; last_state_change_time = time()
-        elif step == 2 and elapsed > 1: set_light_state('all_on'); mode_state['race_step'] += 1; last_state_change_time = time()
-        elif step == 3 and elapsed > 1: set_light_state('off'); mode_state['race_step'] += 1; last_state_change_time = time()
-    else:
-        live_color = iracing_light_status if iracing_light_status != 'black' else 'off'
-        set_light_state(live_color)
-        return 0.05
-
-def handle_space_mode(elapsed):
-    kp = space_weather_status.get('kp_index')
-    if kp is None: set_light_state('red' if current_color != 'red' else 'off'); return 0.5
-    elif kp >= 5: set_light_state('red' if current_color != 'red' else 'off'); return 0.5
-    elif kp == 4: set_light_state('yellow')
-    else: set_light_state('green')
-
-def handle_stau_mode(elapsed):
-    delay = traffic_status.get('avg_delay')
-    if delay is None: set_light_state('red' if current_color != 'red' else 'off'); return 0.5
-    elif delay > 45: set_light_state('red')
-    elif delay > 20: set_light_state('yellow')
-    else: set_light_state('green')
+        publish(mode=current_mode, color=current_color, race_step=program_runner.index if current_mode == 'racing' else 0)
+        try:
+            woken = controller_wakeup.wait(None if deadline is None else max(0, deadline - monotonic()))
+            controller_wakeup.clear() # Before draining, so inputs that arrive from here on wake the next wait.
+            now = monotonic()
+            if deadline is not None and now >= deadline: CONTROLLER_LATENESS.observe(now - deadline)
+            restart = drain_inputs()
+            target = state.target_mode
+            if fleet_following: deadline = None
+            elif restart or current_mode != target or programs[target] is not program_runner.program: deadline = enter_mode(target, now)
+            else: deadline = program_runner.advance(now, woken)
+        except Exception as e:
+            print(f"Controller: mode {current_mode!r} failed, switching to idle: {e!r}", file=sys.stderr)
+            deadline = None
+            publish(target_mode='idle')
+            wake_controller()
 
 # --- Web Server ---
-class StatusHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        global target_mode, target_manual_color, mode_state
-        parsed_path = urlparse(self.path)
-        if parsed_path.path == '/status':
-            self.send_response(200); self.send_header('Content-type', 'application/json'); self.end_headers()
-            with state_lock: status = {'color': current_color, 'mode': current_mode, 's_bahn_minutes': s_bahn_minutes_away, 'weather': weather_status, 'race_step': mode_state.get('race_step', 0), 'space_weather': space_weather_status, 'traffic': traffic_status}
-            self.wfile.write(json.dumps(status).encode('utf-8')); return
-        query_params = parse_qs(parsed_path.query)
-        action = query_params.get('action', [None])[0]
-        if action:
-            with state_lock:
-                if action == 'set_color':
-                    clicked_color = query_params['color'][0]
-                    if current_mode == 'manual' and current_color == clicked_color: target_manual_color = 'off'
-                    else: target_manual_color = clicked_color
-                    target_mode = 'manual'
-                elif action == 'set_mode':
-                    new_mode = query_params['mode'][0]
-                    target_mode = 'idle' if current_mode == new_mode else new_mode
-            self.send_response(200); self.end_headers(); return
-        if parsed_path.path == '/':
-            self.send_response(200); self.send_header('Content-type', 'text/html'); self.end_headers()
-            self.wfile.write(get_html_content().encode('utf-8'))
+MAX_BATCH_COMMANDS = 32
+dashboard = None
+
+def signal_new_version():
+    """Runs on the HTTP loop: releases every request waiting for the next status version."""
+    global version_event
+    version_event.set()
+    version_event = asyncio.Event()
+
+async def wait_for_version_change(version, timeout):
+    """Returns once state.version differs from `version`, or after `timeout` seconds."""
+    deadline = http_loop.time() + timeout
+    while state.version == version and http_loop.time() < deadline:
+        try:
+            await asyncio.wait_for(version_event.wait(), deadline - http_loop.time())
+        except asyncio.TimeoutError:
+            return
+
+def note_status_consumer(stream_delta=0):
+    """Tracks connected dashboards for the polling policy, replanning fetches when the first one shows up.
+
+    Only the HTTP loop writes these counters, so they need no lock; the fetch engine just reads them.
+    """
+    global stream_clients, last_status_poll
+    first_consumer = not status_consumers_connected()
+    stream_clients += stream_delta
+    if stream_delta == 0: last_status_poll = monotonic()
+    if first_consumer: fetch_engine.replan()
+
+def validate_command(command):
+    if not isinstance(command, dict): raise BadRequest(400, "each command must be a JSON object")
+    action = command.get('action')
+    if action == 'set_mode':
+        # Any program is a mode, except 'manual', which is entered through set_color.
+        if command.get('mode') not in programs or command.get('mode') == 'manual': raise BadRequest(400, f"unknown mode: {command.get('mode')!r}")
+    elif action == 'set_color':
+        if command.get('color') not in COLOR_MASKS: raise BadRequest(400, f"unknown color: {command.get('color')!r}")
+    else: raise BadRequest(400, f"unknown action: {action!r}")
+    return command
+
+def apply_commands(commands):
+    """Applies a validated batch in order, on the controller thread, as one state change.
+
+    With `toggle`, repeating the active mode or color turns it off, like the dashboard buttons.
+    """
+    target_mode, manual_color = state.target_mode, state.manual_color
+    mode, color = current_mode, current_color
+    for command in commands:
+        toggle = command.get('toggle', False)
+        if command['action'] == 'set_color':
+            manual_color = 'off' if toggle and mode == 'manual' and color == command['color'] else command['color']
+            target_mode, mode, color = 'manual', 'manual', manual_color
+        else:
+            target_mode = mode = 'idle' if toggle and mode == command['mode'] else command['mode']
+    publish(target_mode=target_mode, manual_color=manual_color)
+    snapshot_due.set()
+
+async def handle_commands(request):
+    """POST /api/commands: one command object, a list of them, or {"commands": [...]}; all are validated before any is applied."""
+    body = request.json()
+    commands = body if isinstance(body, list) else body.get('commands', [body]) if isinstance(body, dict) else None
+    if not isinstance(commands, list) or not commands: raise BadRequest(400, "expected a command object or a non-empty list of commands")
+    if len(commands) > MAX_BATCH_COMMANDS: raise BadRequest(400, f"at most {MAX_BATCH_COMMANDS} commands per request")
+    submit('commands', [validate_command(command) for command in commands])
+    return json_response({'ok': True, 'applied': len(commands)})
+
+async def handle_legacy_command(request):
+    """GET /?action=set_mode&mode=... and /?action=set_color&color=..., with the dashboard's toggle behaviour."""
+    submit('commands', [validate_command(dict(request.query, toggle=True))])
+    return Response(200, content_type=None)
+
+async def handle_list_programs(request):
+    return json_response({'programs': [{'name': program.name, 'builtin': program.builtin, 'steps': len(program.timeline), 'source': program.source} for program in programs.values()]})
+
+async def handle_upload_program(request):
+    """POST /api/programs: compiles and stores a program; activate it with a set_mode command naming it."""
+    try:
+        program = install_program(request.json())
+    except ProgramError as e:
+        raise BadRequest(400, str(e))
+    snapshot_due.set()
+    return json_response({'ok': True, 'name': program.name, 'steps': len(program.timeline)})
+
+def finite_number(raw):
+    """float(raw), rejecting nan and inf, which would end up in the JSON as invalid literals."""
+    value = float(raw)
+    if not math.isfinite(value): raise ValueError(f"not a finite number: {raw!r}")
+    return value
+
+def history_time(raw, now, default):
+    """Parses an epoch time; negative values count back from now, so ?from=-86400 means the last day."""
+    if raw is None: return default
+    value = finite_number(raw)
+    return now + value if value < 0 else value
+
+async def handle_history(request):
+    """GET /history?signal=&from=&to=&step=: streams [time, value] pairs as one JSON document, without signal lists the signals."""
+    name = request.query.get('signal')
+    if name is None: return json_response({'signals': sorted(history.series)})
+    if name not in history.series: raise BadRequest(400, f"unknown signal: {name!r}")
+    now = time()
+    try:
+        since = history_time(request.query.get('from'), now, now - HISTORY_DEFAULT_SPAN_S)
+        until = history_time(request.query.get('to'), now, now)
+        step = None if request.query.get('step') is None else finite_number(request.query['step'])
+    except ValueError:
+        raise BadRequest(400, "from, to and step must be finite numbers")
+    if step is not None and step <= 0: raise BadRequest(400, "step must be positive")
+    resolution, times, values = history.query(name, since, until, step)
+    async def points():
+        yield f'{{"signal": {json.dumps(name)}, "from": {since}, "to": {until}, "step": {resolution}, "points": ['.encode('utf-8')
+        for start in range(0, len(times), HISTORY_CHUNK_POINTS):
+            end = min(start + HISTORY_CHUNK_POINTS, len(times))
+            chunk = ', '.join(f'[{times[i]:.3f}, {values[i]:g}]' for i in range(start, end))
+            yield (', ' + chunk if start else chunk).encode('utf-8')
+        yield b']}'
+    return Response(200, content_type='application/json', headers={'Cache-Control': 'no-cache'}, stream=points())
+
+async def handle_status(request):
+    """Full status; with ?since=<version> it long-polls until the version moves away from the client's copy."""
+    note_status_consumer()
+    since = request.query.get('since')
+    if since is not None:
+        try:
+            await wait_for_version_change(int(since), LONG_POLL_TIMEOUT_S)
+        except ValueError:
+            raise BadRequest(400, "since must be an integer version")
+    current = state
+    status = current.status()
+    status['version'] = current.version
+    status['ages'] = fetch_engine.ages()
+    status['telemetry'] = dict(telemetry_stats)
+    if fleet is not None: status['fleet'] = fleet.status()
+    return json_response(status, headers={'Cache-Control': 'no-cache'})
+
+async def handle_events(request):
+    """Server-Sent Events stream: a full snapshot first, then only the keys that changed."""
+    async def events():
+        note_status_consumer(+1) # Inside the generator: a HEAD closes it unstarted, so it never counts.
+        sent, version = {}, None
+        try:
+            while True:
+                if version is not None: await wait_for_version_change(version, STREAM_KEEPALIVE_S)
+                current = state
+                version, status = current.version, current.status()
+                diff = {key: value for key, value in status.items() if key not in sent or sent[key] != value}
+                sent = status
+                yield (f"id: {version}\ndata: {json.dumps(diff)}\n\n" if diff else ": keepalive\n\n").encode('utf-8')
+        finally:
+            note_status_consumer(-1)
+    return Response(200, content_type='text/event-stream', headers={'Cache-Control': 'no-cache'}, stream=events())
+
+async def handle_metrics(request):
+    return Response(200, render_metrics().encode('utf-8'), 'text/plain; version=0.0.4')
+
+def build_dashboard():
+    """Renders the dashboard once, with a gzip variant and an ETag, since it never changes while we run."""
+    html = get_html_content().encode('utf-8')
+    return {'identity': html, 'gzip': gzip.compress(html, 9), 'etag': f'"{hashlib.sha1(html).hexdigest()[:16]}"'}
+
+async def handle_dashboard(request):
+    headers = {'ETag': dashboard['etag'], 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if request.headers.get('if-none-match') == dashboard['etag']: return Response(304, content_type=None, headers=headers)
+    if 'gzip' in request.headers.get('accept-encoding', ''):
+        return Response(200, dashboard['gzip'], 'text/html; charset=utf-8', dict(headers, **{'Content-Encoding': 'gzip'}))
+    return Response(200, dashboard['identity'], 'text/html; charset=utf-8', headers)
+
+ROUTES = {
+    ('GET', '/'): handle_dashboard, ('GET', '/status'): handle_status, ('GET', '/events'): handle_events,
+    ('GET', '/metrics'): handle_metrics, ('POST', '/api/commands'): handle_commands,
+    ('GET', '/api/programs'): handle_list_programs, ('POST', '/api/programs'): handle_upload_program,
+    ('GET', '/history'): handle_history,
+}
+
+async def app(request):
+    start = perf_counter()
+    try:
+        method = 'GET' if request.method == 'HEAD' else request.method
+        if method == 'GET' and request.path == '/' and 'action' in request.query: return await handle_legacy_command(request)
+        handler = ROUTES.get((method, request.path))
+        if handler is None:
+            known_path = any(path == request.path for _, path in ROUTES)
+            return error_response(405 if known_path else 404, "method not allowed" if known_path else "not found")
+        return await handler(request)
+    finally:
+        HTTP_REQUESTS.observe(perf_counter() - start, (request.path if request.path in HTTP_PATHS else 'other',))
 
 def get_html_content():
-    return f"""
+    return """
     <!DOCTYPE html><html lang="en"><head><title>Traffic Light Control</title><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><meta name="apple-mobile-web-app-capable" content="yes"><meta name="apple-mobile-web-app-status-bar-style" content="black-translucent"><link rel="preconnect" href="https://fonts.googleapis.com"><link rel="preconnect" href="https://fonts.gstatic.com" crossorigin><link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap" rel="stylesheet">
-    <style>:root{{--bg-color:#1a1d23;--body-bg:#111317;--text-color:#e0e0e0;--text-muted:#888;--accent-color:#007bff;--shadow-color:rgba(0,0,0,0.5)}}html,body{{height:100%;margin:0;padding:0;background-color:var(--body-bg);font-family:'Inter',sans-serif;color:var(--text-color);-webkit-tap-highlight-color:transparent;display:flex;justify-content:center;align-items:center}}.container{{width:100%;max-width:380px;padding:20px;box-sizing:border-box;display:flex;flex-direction:column;align-items:center;gap:25px}}.traffic-light-body{{background-color:var(--bg-color);border-radius:24px;padding:20px;display:flex;flex-direction:column;gap:15px;border:1px solid #333;box-shadow:0 10px 30px var(--shadow-color)}}.light{{width:90px;height:90px;border-radius:50%;background-color:#333;opacity:0.5;transition:all .15s ease-in-out;cursor:pointer;box-shadow:inset 0 2px 10px rgba(0,0,0,.4)}}.red-on{{background-color:#ff1c1c;opacity:1;box-shadow:0 0 40px #ff1c1c,inset 0 2px 10px rgba(0,0,0,.4)}}.yellow-on{{background-color:#ffc700;opacity:1;box-shadow:0 0 40px #ffc700,inset 0 2px 10px rgba(0,0,0,.4)}}.green-on{{background-color:#00ff00;opacity:1;box-shadow:0 0 40px #00ff00,inset 0 2px 10px rgba(0,0,0,.4)}}.controls{{text-align:center;width:100%}}#modeText{{font-size:1.5em;font-weight:600;margin-top:0;margin-bottom:8px}}.info-text{{height:22px;font-size:1em;font-style:italic;color:var(--text-muted);margin-bottom:20px}}.mode-buttons{{display:grid;grid-template-columns:1fr 1fr 1fr;gap:10px;width:100%}}.mode-buttons a{{background-color:#333;color:var(--text-color);padding:12px 10px;border-radius:12px;font-size:1em;font-weight:600;text-decoration:none;transition:background-color .2s,transform .1s}}.mode-buttons a:active{{transform:scale(.95)}}.mode-buttons a.active{{background-color:var(--accent-color);color:#fff}}</style></head>
-    <body><div class="container"><div class="traffic-light-body" id="traffic-light"><div id="red" class="light" onclick="handleLightClick('red')"></div><div id="yellow" class="light" onclick="handleLightClick('yellow')"></div><div id="green" class="light" onclick="handleLightClick('green')"></div></div><div class="controls"><h2 id="modeText">Current Mode: <strong></strong></h2><div id="info-display" class="info-text"></div><div class="mode-buttons"><a href="#" id="mode-auto" onclick="handleModeClick('auto')">Auto</a><a href="#" id="mode-emergency" onclick="handleModeClick('emergency')">Emergency</a><a href="#" id="mode-sos" onclick="handleModeClick('sos')">SOS</a><a href="#" id="mode-party" onclick="handleModeClick('party')">Party</a><a href="#" id="mode-s_bahn" onclick="handleModeClick('s_bahn')">S-Bahn</a><a href="#" id="mode-biergarten" onclick="handleModeClick('biergarten')">Biergarten</a><a href="#" id="mode-racing" onclick="handleModeClick('racing')">Racing</a><a href="#" id="mode-stau" onclick="handleModeClick('stau')">Stau</a><a href="#" id="mode-space" onclick="handleModeClick('space')">Space</a></div></div></div>
+    <style>:root{--bg-color:#1a1d23;--body-bg:#111317;--text-color:#e0e0e0;--text-muted:#888;--accent-color:#007bff;--shadow-color:rgba(0,0,0,0.5)}html,body{height:100%;margin:0;padding:0;background-color:var(--body-bg);font-family:'Inter',sans-serif;color:var(--text-color);-webkit-tap-highlight-color:transparent;display:flex;justify-content:center;align-items:center}.container{width:100%;max-width:380px;padding:20px;box-sizing:border-box;display:flex;flex-direction:column;align-items:center;gap:25px}.traffic-light-body{background-color:var(--bg-color);border-radius:24px;padding:20px;display:flex;flex-direction:column;gap:15px;border:1px solid #333;box-shadow:0 10px 30px var(--shadow-color)}.light{width:90px;height:90px;border-radius:50%;background-color:#333;opacity:0.5;transition:all .15s ease-in-out;cursor:pointer;box-shadow:inset 0 2px 10px rgba(0,0,0,.4)}.red-on{background-color:#ff1c1c;opacity:1;box-shadow:0 0 40px #ff1c1c,inset 0 2px 10px rgba(0,0,0,.4)}.yellow-on{background-color:#ffc700;opacity:1;box-shadow:0 0 40px #ffc700,inset 0 2px 10px rgba(0,0,0,.4)}.green-on{background-color:#00ff00;opacity:1;box-shadow:0 0 40px #00ff00,inset 0 2px 10px rgba(0,0,0,.4)}.controls{text-align:center;width:100%}#modeText{font-size:1.5em;font-weight:600;margin-top:0;margin-bottom:8px}.info-text{height:22px;font-size:1em;font-style:italic;color:var(--text-muted);margin-bottom:20px}.mode-buttons{display:grid;grid-template-columns:1fr 1fr 1fr;gap:10px;width:100%}.mode-buttons a{background-color:#333;color:var(--text-color);padding:12px 10px;border-radius:12px;font-size:1em;font-weight:600;text-decoration:none;transition:background-color .2s,transform .1s}.mode-buttons a:active{transform:scale(.95)}.mode-buttons a.active{background-color:var(--accent-color);color:#fff}#sparkline{display:block;width:100%;height:36px;margin:-12px 0 14px}#sparkline polyline{fill:none;stroke:var(--accent-color);stroke-width:2}</style></head>
+    <body><div class="container"><div class="traffic-light-body" id="traffic-light"><div id="red" class="light" onclick="handleLightClick('red')"></div><div id="yellow" class="light" onclick="handleLightClick('yellow')"></div><div id="green" class="light" onclick="handleLightClick('green')"></div></div><div class="controls"><h2 id="modeText">Current Mode: <strong></strong></h2><div id="info-display" class="info-text"></div><svg id="sparkline" viewBox="0 0 300 36" preserveAspectRatio="none"><polyline points=""/></svg><div class="mode-buttons"><a href="#" id="mode-auto" onclick="handleModeClick('auto')">Auto</a><a href="#" id="mode-emergency" onclick="handleModeClick('emergency')">Emergency</a><a href="#" id="mode-sos" onclick="handleModeClick('sos')">SOS</a><a href="#" id="mode-party" onclick="handleModeClick('party')">Party</a><a href="#" id="mode-s_bahn" onclick="handleModeClick('s_bahn')">S-Bahn</a><a href="#" id="mode-biergarten" onclick="handleModeClick('biergarten')">Biergarten</a><a href="#" id="mode-racing" onclick="handleModeClick('racing')">Racing</a><a href="#" id="mode-stau" onclick="handleModeClick('stau')">Stau</a><a href="#" id="mode-space" onclick="handleModeClick('space')">Space</a></div></div></div>
     <script>
         let currentModeFromServer = 'unknown'; let localAnimationId = null;
-        function updateVisuals(color, mode, s_bahn_minutes, weather, race_step, space_weather, traffic) {{
-            if (currentModeFromServer !== mode) {{
+        function updateVisuals(color, mode, s_bahn_minutes, weather, race_step, space_weather, traffic) {
+            if (currentModeFromServer !== mode) {
                 const currentActive = document.querySelector('.mode-buttons a.active');
                 if (currentActive) currentActive.classList.remove('active');
-                if (mode !== 'idle' && mode !== 'manual') {{
-                    const newActive = document.getElementById(`mode-${{mode}}`);
+                if (mode !== 'idle' && mode !== 'manual') {
+                    const newActive = document.getElementById(`mode-${mode}`);
                     if (newActive) newActive.classList.add('active');
-                }}
-            }}
+                }
+                drawSparkline(mode);
+            }
             currentModeFromServer = mode;
             document.querySelector('#modeText strong').textContent = (mode === 'idle') ? 'OFF' : mode.replace('_', ' ').toUpperCase();
             const infoDisplay = document.getElementById('info-display');
-            if (mode === 's_bahn') {{ infoDisplay.textContent = (s_bahn_minutes === -1) ? 'No S-Bahn data.' : `Next train in ${{s_bahn_minutes}} min.`; }}
-            else if (mode === 'biergarten') {{
-                if (weather && weather.temp && weather.condition) {{ infoDisplay.textContent = `${{weather.temp.toFixed(1)}}°C, ${{weather.condition}}`; }}
-                else {{ infoDisplay.textContent = 'No weather data.'; }}
-            }}
-            else if (mode === 'racing' && race_step >= 4) {{ infoDisplay.textContent = 'Listening for iRacing...'; }}
-            else if (mode === 'space') {{
-                if (space_weather && space_weather.kp_index !== undefined) {{ infoDisplay.textContent = `Kp-index: ${{space_weather.kp_index}} (${{space_weather.condition}})`; }}
-                else {{ infoDisplay.textContent = 'No space weather data.'; }}
-            }}
-            else if (mode === 'stau') {{
-                if (traffic && traffic.commute_time) {{ infoDisplay.textContent = `Commute: ${{traffic.commute_time}}`; }}
-                else {{ infoDisplay.textContent = 'No traffic data.'; }}
-            }}
-            else {{ infoDisplay.textContent = ''; }}
+            if (mode === 's_bahn') { infoDisplay.textContent = (s_bahn_minutes === -1) ? 'No S-Bahn data.' : `Next train in ${s_bahn_minutes} min.`; }
+            else if (mode === 'biergarten') {
+                if (weather && weather.temp && weather.condition) { infoDisplay.textContent = `${weather.temp.toFixed(1)}°C, ${weather.condition}`; }
+                else { infoDisplay.textContent = 'No weather data.'; }
+            }
+            else if (mode === 'racing' && race_step >= 4) { infoDisplay.textContent = 'Listening for iRacing...'; }
+            else if (mode === 'space') {
+                if (space_weather && space_weather.kp_index !== undefined) { infoDisplay.textContent = `Kp-index: ${space_weather.kp_index} (${space_weather.condition})`; }
+                else { infoDisplay.textContent = 'No space weather data.'; }
+            }
+            else if (mode === 'stau') {
+                if (traffic && traffic.commute_time) { infoDisplay.textContent = `Commute: ${traffic.commute_time}`; }
+                else { infoDisplay.textContent = 'No traffic data.'; }
+            }
+            else { infoDisplay.textContent = ''; }
             const isRedOn = color === 'red' || color === 'red_and_yellow' || color === 'all_on';
             const isYellowOn = color === 'yellow' || color === 'red_and_yellow' || color === 'all_on' || color === 'green-yellow';
             const isGreenOn = color === 'green' || color === 'all_on' || color === 'green-yellow';
             document.getElementById('red').className = 'light' + (isRedOn ? ' red-on' : '');
             document.getElementById('yellow').className = 'light' + (isYellowOn ? ' yellow-on' : '');
             document.getElementById('green').className = 'light' + (isGreenOn ? ' green-on' : '');
-        }}
-        function stopLocalAnimation() {{ if (localAnimationId) {{ clearInterval(localAnimationId); clearTimeout(localAnimationId); localAnimationId = null; }} }}
-        function startPartyAnimation() {{ stopLocalAnimation(); localAnimationId = setInterval(() => {{ const colors = ['red', 'yellow', 'green', 'off']; updateVisuals(colors[Math.floor(Math.random() * colors.length)], 'party', -1, {{}}, 0, {{}}, {{}}); }}, 80); }}
-        function startSosAnimation() {{
+        }
+        const SPARKLINE_SIGNALS = { s_bahn: 's_bahn_minutes', biergarten: 'temperature', space: 'kp_index', stau: 'traffic_delay' };
+        let sparklineMode = null;
+        async function drawSparkline(mode) {
+            sparklineMode = mode;
+            const line = document.querySelector('#sparkline polyline');
+            const signal = SPARKLINE_SIGNALS[mode];
+            if (!signal) { line.setAttribute('points', ''); return; }
+            try {
+                const history = await (await fetch(`/history?signal=${signal}&from=-86400&step=900`)).json();
+                if (sparklineMode !== mode) return;
+                const values = history.points.map(p => p[1]), min = Math.min(...values), span = (Math.max(...values) - min) || 1;
+                line.setAttribute('points', history.points.map(([t, v]) => `${(300 * (t - history.from) / (history.to - history.from)).toFixed(1)},${(34 - 32 * (v - min) / span).toFixed(1)}`).join(' '));
+            } catch (e) { line.setAttribute('points', ''); }
+        }
+        setInterval(() => drawSparkline(currentModeFromServer), 300000);
+        function stopLocalAnimation() { if (localAnimationId) { clearInterval(localAnimationId); clearTimeout(localAnimationId); localAnimationId = null; applyServerStatus({}); } }
+        function startPartyAnimation() { stopLocalAnimation(); localAnimationId = setInterval(() => { const colors = ['red', 'yellow', 'green', 'off']; updateVisuals(colors[Math.floor(Math.random() * colors.length)], 'party', -1, {}, 0, {}, {}); }, 80); }
+        function startSosAnimation() {
             stopLocalAnimation();
             const sosPattern = [
-                {{state: 'all_on', duration: 200}}, {{state: 'off', duration: 200}},{{state: 'all_on', duration: 200}}, {{state: 'off', duration: 200}},{{state: 'all_on', duration: 200}}, {{state: 'off', duration: 400}},
-                {{state: 'all_on', duration: 600}}, {{state: 'off', duration: 200}},{{state: 'all_on', duration: 600}}, {{state: 'off', duration: 200}},{{state: 'all_on', duration: 600}}, {{state: 'off', duration: 400}},
-                {{state: 'all_on', duration: 200}}, {{state: 'off', duration: 200}},{{state: 'all_on', 'duration': 200}}, {{state: 'off', duration: 200}},{{state: 'all_on', duration: 200}}, {{state: 'off', duration: 1500}},
+                {state: 'all_on', duration: 200}, {state: 'off', duration: 200},{state: 'all_on', duration: 200}, {state: 'off', duration: 200},{state: 'all_on', duration: 200}, {state: 'off', duration: 400},
+                {state: 'all_on', duration: 600}, {state: 'off', duration: 200},{state: 'all_on', duration: 600}, {state: 'off', duration: 200},{state: 'all_on', duration: 600}, {state: 'off', duration: 400},
+                {state: 'all_on', duration: 200}, {state: 'off', duration: 200},{state: 'all_on', 'duration': 200}, {state: 'off', duration: 200},{state: 'all_on', duration: 200}, {state: 'off', duration: 1500},
             ];
             let sosIndex = 0;
-            function runSosStep() {{
+            function runSosStep() {
                 if (currentModeFromServer !== 'sos') return;
-                const step = sosPattern[sosIndex]; updateVisuals(step.state, 'sos', -1, {{}}, 0, {{}}, {{}});
+                const step = sosPattern[sosIndex]; updateVisuals(step.state, 'sos', -1, {}, 0, {}, {});
                 sosIndex = (sosIndex + 1) % sosPattern.length;
                 localAnimationId = setTimeout(runSosStep, step.duration);
-            }}
+            }
             runSosStep();
-        }}
-        function handleLightClick(color) {{ stopLocalAnimation(); fetch(`/?action=set_color&color=${{color}}`); }}
-        function handleModeClick(mode) {{
+        }
+        function sendCommand(command) { return fetch('/api/commands', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(command) }); }
+        function handleLightClick(color) { stopLocalAnimation(); sendCommand({ action: 'set_color', color: color, toggle: true }); }
+        function handleModeClick(mode) {
             const isTogglingOff = currentModeFromServer === mode;
-            stopLocalAnimation(); fetch(`/?action=set_mode&mode=${{mode}}`);
-            if (!isTogglingOff) {{ if (mode === 'party') startPartyAnimation(); else if (mode === 'sos') startSosAnimation(); }}
-        }}
-        async function syncWithServer() {{
-            if (localAnimationId) return;
-            try {{
-                const response = await fetch('/status');
-                const status = await response.json();
-                updateVisuals(status.color, status.mode, status.s_bahn_minutes, status.weather, status.race_step, status.space_weather, status.traffic);
-            }} catch (e) {{}}
-        }}
-        setInterval(syncWithServer, 400);
-        syncWithServer();
+            stopLocalAnimation(); sendCommand({ action: 'set_mode', mode: mode, toggle: true });
+            if (!isTogglingOff) { if (mode === 'party') startPartyAnimation(); else if (mode === 'sos') startSosAnimation(); }
+        }
+        const serverStatus = {};
+        function applyServerStatus(update) {
+            Object.assign(serverStatus, update);
+            if (localAnimationId || serverStatus.mode === undefined) return;
+            updateVisuals(serverStatus.color, serverStatus.mode, serverStatus.s_bahn_minutes, serverStatus.weather, serverStatus.race_step, serverStatus.space_weather, serverStatus.traffic);
+        }
+        async function longPollServer() {
+            let version = -1;
+            while (true) {
+                try {
+                    const response = await fetch(`/status?since=${version}`);
+                    const status = await response.json();
+                    version = status.version; applyServerStatus(status);
+                } catch (e) { await new Promise(resolve => setTimeout(resolve, 2000)); }
+            }
+        }
+        function connectToServer() {
+            if (!window.EventSource) { longPollServer(); return; }
+            const events = new EventSource('/events');
+            events.onmessage = (e) => applyServerStatus(JSON.parse(e.data));
+            events.onerror = () => { if (events.readyState === EventSource.CLOSED) longPollServer(); };
+        }
+        connectToServer();
     </script>
     </body></html>
     """
 
+# --- Fleet Replication ---
+# FLEET_ROLE=coordinator broadcasts every light change; FLEET_ROLE=follower mirrors them and fetches nothing while it does.
+FLEET_ROLE = os.getenv("FLEET_ROLE", "standalone")
+FLEET_GROUP = os.getenv("FLEET_GROUP", "239.255.42.99")
+FLEET_PORT = int(os.getenv("FLEET_PORT", 9002))
+FLEET_MASK_COLORS = {mask: color for color, mask in COLOR_MASKS.items()}
+fleet = None
+fleet_following = False
+Callback('traffic_light_fleet_frames_total', "Fleet frames by outcome.", 'counter', ('result',), lambda: {(result,): count for result, count in fleet.stats.items()} if fleet else {})
+
+def apply_fleet_frame(mode, mask):
+    """Runs on the fleet thread at the frame's apply time: hands the coordinator's light and mode to the controller."""
+    submit('fleet', mode, mask)
+
+def set_fleet_following(following):
+    global fleet_following
+    print(f"Fleet: {'following the coordinator' if following else 'coordinator silent, running on our own'}")
+    fleet_following = following
+    submit('follow', following) # Restarts the last mirrored mode from its first step when we go solo.
+    fetch_engine.replan()
+
+def start_fleet():
+    """Creates the fleet role's replicator thread. Must run before the controller starts."""
+    global fleet, fleet_following
+    if FLEET_ROLE == 'coordinator':
+        fleet = FleetCoordinator(FLEET_GROUP, FLEET_PORT, light_backend.write)
+    elif FLEET_ROLE == 'follower':
+        fleet = FleetFollower(FLEET_GROUP, FLEET_PORT, apply_fleet_frame, set_fleet_following)
+        fleet_following = fleet.following
+    else:
+        return
+    threading.Thread(target=fleet.run, daemon=True, name='fleet').start()
+    print(f"Fleet {FLEET_ROLE} on {FLEET_GROUP}:{FLEET_PORT}")
+
+# --- Warm Start Snapshot ---
+# The mode, user programs, upstream values and the timetable cache are saved periodically and loaded before the
+# monitors start, so every mode shows real data right after a reboot.
+STATE_FILE = os.getenv("STATE_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "traffic_light_state.json"))
+SNAPSHOT_VERSION = 1
+SNAPSHOT_INTERVAL_S = 60
+SNAPSHOT_MAX_AGE_S = 6 * 3600 # Older upstream values are dropped rather than shown as current.
+snapshot_due = threading.Event() # Set after commands and uploads, so they are saved without waiting a full interval.
+restored_sources = {} # name -> (value, epoch fetched_at), seeded into the fetch engine on registration.
+restored_timetable = None
+
+def build_snapshot():
+    current = state
+    snapshot = {'version': SNAPSHOT_VERSION, 'target_mode': current.target_mode, 'manual_color': current.manual_color,
+                'programs': [program.source for program in programs.values() if not program.builtin]}
+    snapshot['sources'] = fetch_engine.snapshot()
+    if s_bahn_timetable is not None: snapshot['timetable'] = s_bahn_timetable.export()
+    return snapshot
+
+def save_snapshot(data):
+    """Replaces the state file atomically, so a crash or power cut mid-write leaves the previous snapshot intact."""
+    tmp = f"{STATE_FILE}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, STATE_FILE)
+
+def write_snapshot(last=None):
+    """Saves the current snapshot unless it equals `last`, sparing the SD card; returns what is on disk now."""
+    try:
+        data = json.dumps(build_snapshot(), separators=(',', ':')).encode('utf-8')
+        if data != last: save_snapshot(data)
+        return data
+    except (OSError, TypeError, ValueError) as e:
+        print(f"Could not save state to {STATE_FILE}: {e}", file=sys.stderr)
+        return last
+
+def snapshot_writer():
+    """Saves the snapshot every SNAPSHOT_INTERVAL_S, or soon after a command changed what should survive a restart."""
+    last = None
+    while True:
+        snapshot_due.wait(SNAPSHOT_INTERVAL_S)
+        snapshot_due.clear()
+        last = write_snapshot(last)
+
+def load_snapshot():
+    """Restores the last mode, user programs and upstream values. Must run before the controller and monitors start."""
+    global restored_timetable
+    try:
+        with open(STATE_FILE, 'rb') as f: snapshot = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable state file {STATE_FILE}: {e}", file=sys.stderr); return
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION: return
+    for source in snapshot.get('programs', []):
+        try:
+            install_program(source)
+        except ProgramError as e:
+            print(f"Dropping saved program: {e}", file=sys.stderr)
+    if snapshot.get('target_mode') in programs: publish(target_mode=snapshot['target_mode'])
+    if snapshot.get('manual_color') in COLOR_MASKS: publish(manual_color=snapshot['manual_color'])
+    now = time()
+    for name, entry in snapshot.get('sources', {}).items():
+        fetched_at = entry.get('fetched_at') if isinstance(entry, dict) else None
+        if name not in SOURCE_MODES or not isinstance(fetched_at, (int, float)) or now - fetched_at > SNAPSHOT_MAX_AGE_S: continue
+        restored_sources[name] = (entry.get('value'), fetched_at)
+        if name != 's_bahn': update_monitor(name, entry.get('value'), fetched_at) # Minutes to the train are recomputed from the timetable.
+    restored_timetable = snapshot.get('timetable')
+    print(f"Warm start: mode {state.target_mode}, cached {', '.join(sorted(restored_sources)) or 'nothing'}")
+
+def restore_timetable(timetable):
+    """Loads the saved timetable cache and shows the next train from it without touching the network."""
+    if restored_timetable is None: return
+    try:
+        timetable.restore(restored_timetable)
+    except (AttributeError, TypeError, ValueError) as e:
+        print(f"Ignoring saved timetable: {e}", file=sys.stderr); return
+    departure = timetable.next_departure(refresh=False)
+    if departure is None: return
+    minutes = int((departure - time()) / 60)
+    update_monitor('s_bahn', minutes, None)
+    if 's_bahn' in restored_sources: restored_sources['s_bahn'] = (minutes, restored_sources['s_bahn'][1])
+
 # --- Initialization and Server Start ---
 def initialization_sequence():
     """Cycles through lights on startup to confirm they work."""
     print("Running initialization sequence...")
-    initial_lights = [red, yellow, green];
-    for light in initial_lights: light.on(); sleep(0.2); light.off()
+    for light in (RED, YELLOW, GREEN): light_backend.write(light); sleep(0.2); light_backend.write(0)
     print("Initialization complete.")
 
-class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
-    daemon_threads = True
+HTTP_PORT = int(os.getenv("HTTP_PORT", 8000))
 
 def run_server():
-    """Sets up and runs the web server indefinitely."""
-    server_address = ('0.0.0.0', 8000)
-    httpd = ThreadingHTTPServer(server_address, StatusHandler)
-    print(f"Web server running. Access it at http://<your_pi_ip>:8000")
-    httpd.serve_forever()
+    """Runs the single-threaded HTTP server on its own asyncio loop, indefinitely."""
+    global dashboard
+    dashboard = build_dashboard()
+    async def serve():
+        global http_loop, version_event
+        version_event = asyncio.Event()
+        http_loop = asyncio.get_running_loop()
+        print(f"Web server running. Access it at http://<your_pi_ip>:{HTTP_PORT}")
+        await HTTPServer(app).serve('0.0.0.0', HTTP_PORT)
+    asyncio.run(serve())
 
 if __name__ == "__main__":
     try:
         initialization_sequence()
-        threading.Thread(target=traffic_light_controller, daemon=True).start()
-        threading.Thread(target=s_bahn_monitor, daemon=True).start()
-        threading.Thread(target=weather_monitor, daemon=True).start()
-        threading.Thread(target=iracing_udp_listener, daemon=True).start()
-        threading.Thread(target=space_weather_monitor, daemon=True).start()
-        threading.Thread(target=traffic_monitor, daemon=True).start()
-        run_server()
+        load_snapshot()
+        start_fleet()
+        threading.Thread(target=traffic_light_controller, daemon=True, name='controller').start()
+        start_monitors()
+        threading.Thread(target=snapshot_writer, daemon=True, name='snapshot').start()
+        threading.Thread(target=iracing_udp_listener, daemon=True, name='udp').start()
+        server_thread = threading.Thread(target=run_server, daemon=True, name='http')
+        server_thread.start()
+        server_thread.join()
     except KeyboardInterrupt:
         print("\nStopping program.")
-        GPIO.cleanup()
+        write_snapshot()
+        light_backend.close()
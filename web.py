@@ -0,0 +1,143 @@
+"""Minimal single-threaded HTTP/1.1 server on asyncio, with keep-alive and streamed (chunked) responses."""
+import asyncio
+import json
+import sys
+from urllib.parse import urlsplit, parse_qs
+
+KEEPALIVE_TIMEOUT_S = 30
+MAX_LINE_BYTES = 8192
+MAX_HEADERS = 100
+MAX_BODY_BYTES = 64 * 1024
+REASONS = {200: 'OK', 204: 'No Content', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           408: 'Request Timeout', 413: 'Payload Too Large', 431: 'Request Header Fields Too Large', 500: 'Internal Server Error', 501: 'Not Implemented'}
+
+class BadRequest(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class Request:
+    def __init__(self, method, target, version, headers, body):
+        self.method, self.target, self.version, self.headers, self.body = method, target, version, headers, body
+        parts = urlsplit(target)
+        self.path = parts.path
+        self.query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+
+    def json(self):
+        try:
+            return json.loads(self.body or b'null')
+        except ValueError as e:
+            raise BadRequest(400, f"invalid JSON: {e}")
+
+class Response:
+    """A complete body, or `stream`: an async iterator of byte chunks sent with chunked transfer encoding."""
+    def __init__(self, status=200, body=b'', content_type='text/plain; charset=utf-8', headers=None, stream=None):
+        self.status, self.body, self.stream = status, body, stream
+        self.headers = {'Content-Type': content_type} if content_type else {}
+        self.headers.update(headers or {})
+
+def json_response(data, status=200, headers=None):
+    return Response(status, json.dumps(data).encode('utf-8'), 'application/json', headers)
+
+def error_response(status, message):
+    return json_response({'error': message}, status)
+
+async def read_line(reader, status, message):
+    """Reads one line of at most MAX_LINE_BYTES, answering a longer one with `status`."""
+    try:
+        line = await reader.readline()
+    except (ValueError, asyncio.LimitOverrunError): # Longer than the stream limit, which is MAX_LINE_BYTES.
+        raise BadRequest(status, message) from None
+    if len(line) > MAX_LINE_BYTES: raise BadRequest(status, message)
+    return line
+
+async def read_request(reader):
+    """Parses one request from the connection, or returns None when the client closed it."""
+    line = await read_line(reader, 400, "request line too long")
+    if not line: return None
+    if not line.endswith(b'\n'): raise BadRequest(400, "request line too long")
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise BadRequest(400, "malformed request line")
+    if not version.startswith('HTTP/1.'): raise BadRequest(400, "unsupported HTTP version")
+    headers = {}
+    while True:
+        line = await read_line(reader, 431, "headers too large")
+        if len(headers) > MAX_HEADERS: raise BadRequest(431, "headers too large")
+        if line in (b'\r\n', b'\n', b''): break
+        name, sep, value = line.decode('latin-1').partition(':')
+        if not sep: raise BadRequest(400, "malformed header")
+        headers[name.strip().lower()] = value.strip()
+    if 'chunked' in headers.get('transfer-encoding', '').lower(): raise BadRequest(501, "chunked request bodies are not supported")
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise BadRequest(400, "invalid Content-Length")
+    if length < 0 or length > MAX_BODY_BYTES: raise BadRequest(413, "request body too large")
+    body = await reader.readexactly(length) if length else b''
+    return Request(method.upper(), target, version, headers, body)
+
+def head(status, headers):
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}"] + [f"{name}: {value}" for name, value in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+async def write_response(writer, request, response, keep_alive):
+    headers = dict(response.headers)
+    headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+    if response.stream is None:
+        headers['Content-Length'] = str(len(response.body))
+        writer.write(head(response.status, headers) + (b'' if request.method == 'HEAD' else response.body))
+        await writer.drain()
+        return
+    chunked = request.version == 'HTTP/1.1' # HTTP/1.0 has no chunking: the body ends when the connection closes.
+    if chunked: headers['Transfer-Encoding'] = 'chunked'
+    writer.write(head(response.status, headers))
+    try:
+        if request.method == 'HEAD':
+            await writer.drain()
+            return
+        async for chunk in response.stream:
+            if chunk:
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                await writer.drain()
+        if chunked: writer.write(b'0\r\n\r\n')
+        await writer.drain()
+    finally:
+        await response.stream.aclose()
+
+class HTTPServer:
+    """Serves `app(request) -> Response` coroutines; a failing handler yields a 500, never a dead connection."""
+    def __init__(self, app):
+        self.app = app
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), KEEPALIVE_TIMEOUT_S)
+                except BadRequest as e:
+                    writer.write(head(e.status, {'Content-Length': str(len(str(e))), 'Connection': 'close'}) + str(e).encode('latin-1'))
+                    await writer.drain(); return
+                if request is None: return
+                try:
+                    response = await self.app(request)
+                except BadRequest as e:
+                    response = error_response(e.status, str(e))
+                except Exception as e:
+                    print(f"Error handling {request.method} {request.path}: {e!r}", file=sys.stderr)
+                    response = error_response(500, "internal error")
+                connection = request.headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if request.version == 'HTTP/1.1' else connection == 'keep-alive'
+                if response.stream is not None and request.version != 'HTTP/1.1': keep_alive = False
+                await write_response(writer, request, response, keep_alive)
+                if not keep_alive: return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_LINE_BYTES)
+        async with server:
+            await server.serve_forever()